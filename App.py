@@ -1,10 +1,18 @@
-from flask import Flask, render_template, redirect, request, session, flash
+from flask import Flask, Response, render_template, redirect, request, session, flash, stream_with_context, jsonify, g
 from Database import Database
-from Invoker import Invoker
+from Invoker import BaseInvoker, Invoker, AsyncInvoker, InvokeResult
+from Cache import LRUCache, MessageCache
+from SessionStore import DatabaseSessionStore, MemorySessionStore, ServerSessionInterface
+from markupsafe import escape
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Optional
 import os
-import sqlite3
+import asyncio
+import time
+import json
+import bisect
+import threading
+import Metrics
 
 '''
     备注：
@@ -15,28 +23,201 @@ app = Flask(__name__)
     备注：
     session是Flask的内置对象，是一个字典，用于存储用户会话信息
     工作流程：
-    1. 登陆后，Flask后端将用户信息存储到session中，使用secret_key加密后发送到浏览器，存储在cookie中
-    2. 用户后续访问时，浏览器自动发送cookie，Flask解密验证后，将数据加载到session对象中
+    1. 登陆后，Flask后端将用户信息存储到session中，session数据保存在服务器端（见SessionStore.py），cookie中只有随机的会话id
+    2. 用户后续访问时，浏览器自动发送cookie，Flask按会话id从存储中读取数据，加载到session对象中
+    3. 对话的设置（temp）不保存在session中，而是按对话从chat_sessions读取并缓存，因此同一用户可以在多个标签页中使用不同的对话
 '''
 try:    
     app.secret_key = os.getenv("SECRET_KEY")
 except Exception as e:
     raise ValueError(f"ERROR: Failed to set secret key: {str(e)}")
 
+# add a Server-Timing header with the time spent in each stage of the request, for debugging slow requests
+server_timing = os.getenv("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    Metrics.start_timings()
+
+@app.after_request
+def record_request_metrics(response):
+    '''
+        Observe the latency of the request by route, for a streamed response only until the headers are sent
+    '''
+    seconds = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    Metrics.http_request_seconds.observe(seconds, method=request.method, route=route, status=str(response.status_code))
+    if server_timing:
+        response.headers["Server-Timing"] = Metrics.server_timing(Metrics.get_timings() or {}, seconds)
+    return response
+
+@app.teardown_request
+def record_request_exception(error):
+    if error is not None:
+        Metrics.http_exceptions.inc(route=request.url_rule.rule if request.url_rule else "unmatched", type=type(error).__name__)
+
 def get_database() -> Database:
-    return Database("Data.db", "Schema.sql")
+    return Database.instance("Data.db", "Schema.sql")
+
+@app.teardown_appcontext
+def release_database(error):
+    # the connection goes back to the idle pool, a server starting a thread per request would leak one per request otherwise
+    get_database().release()
+
+# SESSION_STORE=memory keeps the sessions in the process, only for a single process
+app.session_interface = ServerSessionInterface(MemorySessionStore() if os.getenv("SESSION_STORE", "database") == "memory" else DatabaseSessionStore(get_database))
 
 def get_invoker(api_key: str, role: Optional[str] = None) -> Invoker:
     return Invoker(api_key, role)
 
-def get_message_list(messages: list[sqlite3.Row]) -> list[dict]:
+'''
+    备注：
+    Flask默认用asgiref为每个async视图新建一个事件循环，绑定在事件循环上的asyncio.Semaphore和AsyncOpenAI连接池无法跨请求共享
+    因此所有async视图都在进程内唯一的后台事件循环中运行（app.async_to_sync）：
+    1. MAX_UPSTREAM_CONCURRENCY限制的是整个进程同时进行的上游请求数
+    2. AsyncOpenAI客户端按API key在事件循环中复用，保持长连接，不必每轮对话重新进行TLS握手
+    3. 视图中的数据库操作用asyncio.to_thread在线程池中执行，不阻塞事件循环
+    后台事件循环按进程id创建，gunicorn fork出的工作进程会创建自己的事件循环
+    限制：应用仍然是WSGI应用，请求线程会一直等待视图完成（包括上游请求），
+    因此每个工作进程同时进行的对话数仍然受THREADS限制，THREADS小于MAX_UPSTREAM_CONCURRENCY时该上限不会起作用
+    要让一个进程同时保持数百个对话，需要在ASGI服务器中运行对话接口
+'''
+upstream_loop = None
+upstream_semaphore = None
+upstream_loop_pid = None
+upstream_loop_lock = threading.Lock()
+
+def get_upstream_loop() -> asyncio.AbstractEventLoop:
+    '''
+        Get the event loop of the async views, started in a daemon thread on first use in each process
+    '''
+    global upstream_loop, upstream_semaphore, upstream_loop_pid
+    with upstream_loop_lock:
+        if upstream_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="upstream-loop", daemon=True).start()
+            upstream_semaphore = asyncio.Semaphore(int(os.getenv("MAX_UPSTREAM_CONCURRENCY", "64")))
+            upstream_loop, upstream_loop_pid = loop, os.getpid()
+        return upstream_loop
+
+def run_in_upstream_loop(func: Callable) -> Callable:
+    '''
+        Run the async view in the upstream event loop and wait for it in the request thread
+            the context of the request thread (request, session, g) is copied to the coroutine
+            the request thread is blocked until the view returns, upstream call included
+    '''
+    def run(*args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(func(*args, **kwargs), get_upstream_loop()).result()
+    return run
+
+app.async_to_sync = run_in_upstream_loop
+
+def get_async_invoker(api_key: str, role: Optional[str] = None) -> AsyncInvoker:
+    # only in the upstream event loop, the semaphore is shared by all the requests of the process
+    return AsyncInvoker(api_key, role, semaphore=upstream_semaphore)
+
+message_cache = None
+message_cache_lock = threading.Lock()
+
+def get_message_cache() -> MessageCache:
+    '''
+        Get the process-wide message cache
+    '''
+    global message_cache
+    with message_cache_lock:
+        if message_cache is None:
+            message_cache = MessageCache(get_database())
+        return message_cache
+
+# (user_id, session_id) -> settings of the chat, the settings do not change after the chat is created
+chat_settings = LRUCache(4096)
+
+def get_chat_settings(user_id: int, session_id: int) -> Optional[dict]:
+    '''
+        Get the settings of the chat session of the user, None if the user has no such chat
+    '''
+    settings = chat_settings.get((user_id, session_id))
+    if settings is None:
+        row = get_database().execute("SELECT temp FROM chat_sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id), fetchone=True)
+        if not row:
+            return None
+        settings = {"temp": row["temp"]}
+        chat_settings.put((user_id, session_id), settings)
+    return settings
+
+def get_context_messages(invoker: BaseInvoker, user_id: int, session_id: int, summarize: Optional[Callable[[list[dict], Optional[str]], InvokeResult]] = None) -> list[dict]:
+    '''
+        Get the messages sent to the API: the system prompt, the stored summary and the latest messages within the token budget
+            the summary and the first message of the window are stored in chat_sessions,
+            so they are only recomputed when the window exceeds the budget, every few turns (see compact_messages)
+            summarize is invoker.summarize by default, an AsyncInvoker has to pass a blocking one
+    '''
+    db = get_database()
+    chat = db.execute("SELECT session_summary, context_start_id FROM chat_sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id), fetchone=True)
+    messages, ids = get_message_cache().get_messages(user_id, session_id, with_ids=True)
+    if not chat:
+        return messages
+    system = messages[:1] if messages and messages[0]["role"] == "system" else []
+    window = messages[max(bisect.bisect_left(ids, chat["context_start_id"]), len(system)):]
+    summary = chat["session_summary"]
+    kept, dropped = invoker.compact_messages(system + window, summary)
+    kept = kept[len(system):]
+    if not dropped:
+        return system + ([invoker.summary_message(summary)] if summary else []) + kept
+    # the window exceeds the budget, move its start forward to the low-water mark and store it
+    if invoker.summarize_history:
+        new_summary = (summarize or invoker.summarize)(dropped, summary)
+        if new_summary.ok:
+            summary = new_summary
+    db.execute("UPDATE chat_sessions SET session_summary = ?, context_start_id = ? WHERE user_id = ? AND session_id = ?", (summary, ids[len(messages) - len(kept)], user_id, session_id))
+    return system + ([invoker.summary_message(summary)] if summary else []) + kept
+
+def get_message_page(user_id: int, session_id: int, before: Optional[int] = None, limit: int = 50) -> tuple[list[dict], Optional[int]]:
+    '''
+        Get a page of the visible messages older than the message id "before", the latest page if before is None
+            1. keyset pagination over idx_messages_user_session_id, the cost does not depend on the page number
+            2. return (messages in ascending order, the "before" of the next older page or None)
+    '''
+    db = get_database()
+    rows = db.execute("SELECT message_id, message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? AND message_id < ? AND message_role != 'system' ORDER BY message_id DESC LIMIT ?", (user_id, session_id, before if before is not None else 2 ** 63 - 1, limit + 1), fetchall=True)
+    next_before = rows[limit - 1]["message_id"] if len(rows) > limit else None
+    messages = [{"id": row["message_id"], "role": row["message_role"], "content": row["message_content"]} for row in rows[:limit]]
+    messages.reverse()
+    return messages, next_before
+
+def get_session_page(user_id: int, before: Optional[int] = None, limit: int = 20) -> tuple[list, Optional[int]]:
+    '''
+        Get a page of chat sessions created before the session "before", the latest page if before is None
+            1. keyset pagination over idx_chat_sessions_user_created, ordered by (session_created_at, session_id) descending
+            2. message_count and last_activity_at are maintained by triggers, no lookup per session is needed
+            3. return (sessions, the "before" of the next page or None)
+    '''
+    db = get_database()
+    columns = "session_id, session_role, session_title, temp, session_created_at, message_count, last_activity_at"
+    if before is None:
+        rows = db.execute(f"SELECT {columns} FROM chat_sessions WHERE user_id = ? ORDER BY session_created_at DESC, session_id DESC LIMIT ?", (user_id, limit + 1), fetchall=True)
+    else:
+        rows = db.execute(f"SELECT {columns} FROM chat_sessions WHERE user_id = ? AND (session_created_at, session_id) < (SELECT session_created_at, session_id FROM chat_sessions WHERE user_id = ? AND session_id = ?) ORDER BY session_created_at DESC, session_id DESC LIMIT ?", (user_id, user_id, before, limit + 1), fetchall=True)
+    next_before = rows[limit - 1]["session_id"] if len(rows) > limit else None
+    return rows[:limit], next_before
+
+def get_search_page(user_id: int, text: str, page: int = 1, limit: int = 20) -> tuple[list[dict], bool]:
     '''
-        Get the message list from the database
+        Get a page of the full-text search results of the user, best matches first
+            1. the snippet is HTML-escaped, the matched words are wrapped in <mark>
+            2. return (results, whether there is a next page)
     '''
-    message_list = []
-    for message in messages:
-        message_list.append({"role": message["message_role"], "content": message["message_content"]})
-    return message_list
+    # control characters cannot appear in the escaped text, so they mark the matched words until the snippet is escaped
+    rows = get_database().search_messages(user_id, text, limit + 1, (page - 1) * limit, highlight=("\x02", "\x03"))
+    results = [{
+        "message_id": row["message_id"],
+        "session_id": row["session_id"],
+        "role": row["message_role"],
+        "session_title": row["session_title"],
+        "snippet": str(escape(row["snippet"])).replace("\x02", "<mark>").replace("\x03", "</mark>")
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
 
 @app.route("/")
 def entry():
@@ -56,10 +237,16 @@ def login():
             return redirect("/login")
         # check validity of the api_key
         invoker = get_invoker(api_key)
-        if not invoker.test_api_key_validity():
+        try:
+            valid = invoker.test_api_key_validity()
+        except RuntimeError:
+            flash("ERROR: Failed to validate the API key, please try again later")
+            return redirect("/login")
+        if not valid:
             flash("ERROR: Invalid API key")
             return redirect("/login")
-        # login successfully
+        # login successfully, the session gets a new id
+        session.regenerate()
         session["logged_in"] = True
         session["user_id"] = user["user_id"]
         session["username"] = username
@@ -115,15 +302,15 @@ def create_chat():
         # create the chat session
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         db = get_database()
-        db.execute("INSERT INTO chat_sessions (user_id, session_role, session_title, temp, session_created_at) VALUES (?, ?, ?, ?, ?)", (session["user_id"], role, title, temp, created_at))
-        session_id = db.execute("SELECT session_id FROM chat_sessions WHERE session_created_at = ?", (created_at,), fetchone=True)["session_id"]
-        if not session_id:
+        # the chat session and its initial message are created in one transaction
+        try:
+            with db.transaction():
+                session_id = db.insert("INSERT INTO chat_sessions (user_id, session_role, session_title, temp, session_created_at, last_activity_at) VALUES (?, ?, ?, ?, ?, ?)", (session["user_id"], role, title, temp, created_at, created_at))
+                db.insert("INSERT INTO messages (session_id, message_role, message_content, user_id) VALUES (?, ?, ?, ?)", (session_id, "system", role, session["user_id"]))
+        except RuntimeError:
             flash("ERROR: Failed to create chat session")
             return redirect("/chat/create")
-        session["chat_session_id"] = session_id
-        session["chat_session_temp"] = temp
-        # create the initial message
-        db.execute("INSERT INTO messages (session_id, message_role, message_content, user_id) VALUES (?, ?, ?, ?)", (session_id, "system", role, session["user_id"]))
+        chat_settings.put((session["user_id"], session_id), {"temp": temp})
         flash("SUCCESS: Chat session created successfully")
         return redirect(f"/chat/{session_id}")
     elif request.method == "GET":
@@ -135,39 +322,184 @@ def create_chat():
 @app.route("/chat/<int:session_id>", methods=["GET", "POST"])
 def chat_session(session_id):
     if request.method == "POST":
+        if not session.get("logged_in", False):
+            flash("ERROR: Please login first")
+            return redirect("/login")
+        settings = get_chat_settings(session["user_id"], session_id)
+        if settings is None:
+            flash("ERROR: Chat session not found")
+            return redirect("/chat")
         input_message = request.form.get("message")
         # input_message has been checked in the frontend, so it's not null
         # create the user message
         db = get_database()
         db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (session["user_id"], session_id, "user", input_message))
-        messages = db.execute("SELECT message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? ORDER BY message_id ASC", (session["user_id"], session_id), fetchall=True)
-        messages = get_message_list(messages)
         # invoke the API
         invoker = get_invoker(session["api_key"])
-        response = invoker.message_invoke(messages, temp=session["chat_session_temp"])
-        if "ERROR" in response:
+        with Metrics.timed("prompt"):
+            messages = get_context_messages(invoker, session["user_id"], session_id)
+        response = invoker.message_invoke(messages, temp=settings["temp"])
+        if not response.ok:
             flash("ERROR: Failed to invoke API")
             return redirect(f"/chat/{session_id}")
         # create the assistant message
         db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (session["user_id"], session_id, "assistant", response))
-        messages = db.execute("SELECT message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? ORDER BY message_id ASC", (session["user_id"], session_id), fetchall=True)
-        return render_template("chat.html", messages=messages, username=session["username"], chat_id=session_id)
+        return redirect(f"/chat/{session_id}")
     elif request.method == "GET":
         if not session.get("logged_in", False):
             flash("ERROR: Please login first")
             return redirect("/login")
-        db = get_database()
-        messages = db.execute("SELECT message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? ORDER BY message_id ASC", (session["user_id"], session_id), fetchall=True)
-        return render_template("chat.html", messages=messages, username=session["username"], chat_id=session_id)
+        # only the latest page is rendered, the older pages are loaded by the browser on scroll
+        messages, next_before = get_message_page(session["user_id"], session_id)
+        with Metrics.timed("render"):
+            return render_template("chat.html", messages=messages, next_before=next_before, username=session["username"], chat_id=session_id)
+
+@app.route("/chat/<int:session_id>/stream", methods=["POST"])
+def chat_session_stream(session_id):
+    '''
+        Stream the assistant reply to the browser with Server-Sent Events
+            1. "data:" events carry the content deltas as JSON strings
+            2. the "done" event is sent after the assistant message is stored
+            3. the "error" event is sent if the API invocation fails
+    '''
+    if not session.get("logged_in", False):
+        return Response("ERROR: Please login first", status=401)
+    input_message = request.form.get("message")
+    if not input_message or not input_message.strip():
+        return Response("ERROR: Empty message", status=400)
+    user_id = session["user_id"]
+    settings = get_chat_settings(user_id, session_id)
+    if settings is None:
+        return Response("ERROR: Chat session not found", status=404)
+    temp = settings["temp"]
+    # create the user message
+    db = get_database()
+    db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (user_id, session_id, "user", input_message))
+    invoker = get_invoker(session["api_key"])
+    with Metrics.timed("prompt"):
+        messages = get_context_messages(invoker, user_id, session_id)
+
+    '''
+        备注：
+        SSE（Server-Sent Events）格式：每个事件由若干行"字段: 值"组成，以空行结尾
+        stream_with_context用于在生成器执行期间保留请求上下文
+    '''
+    def generate():
+        chunks = []
+        try:
+            for delta in invoker.stream_invoke(messages, temp=temp):
+                chunks.append(delta)
+                yield f"data: {json.dumps(delta)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+            return
+        # create the assistant message once the stream is closed
+        db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (user_id, session_id, "assistant", "".join(chunks)))
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/chat/<int:session_id>/messages", methods=["GET"])
+def api_get_messages(session_id):
+    '''
+        Get a page of messages as JSON
+            query parameters: before (message id, optional), limit (1 to 200, 50 by default)
+    '''
+    if not session.get("logged_in", False):
+        return jsonify({"error": "ERROR: Please login first"}), 401
+    before = request.args.get("before", type=int)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+    messages, next_before = get_message_page(session["user_id"], session_id, before, limit)
+    return jsonify({"messages": messages, "next_before": next_before})
+
+@app.route("/api/chat/<int:session_id>/messages", methods=["POST"])
+async def api_post_message(session_id):
+    '''
+        Send a message and return the new turn as JSON, with the AsyncInvoker
+            the request thread still waits for the whole upstream call (see run_in_upstream_loop),
+            the chat page uses the synchronous /chat/<id>/stream instead
+    '''
+    '''
+        备注：
+        该视图在后台事件循环中运行（见run_in_upstream_loop），数据库操作都放在线程池中执行
+    '''
+    if not session.get("logged_in", False):
+        return jsonify({"error": "ERROR: Please login first"}), 401
+    input_message = request.form.get("message")
+    if not input_message or not input_message.strip():
+        return jsonify({"error": "ERROR: Empty message"}), 400
+    user_id = session["user_id"]
+    invoker = get_async_invoker(session["api_key"])
+    loop = asyncio.get_running_loop()
+    def summarize(messages: list[dict], summary: Optional[str]) -> InvokeResult:
+        # called in the worker thread, the summary is requested in the loop
+        return asyncio.run_coroutine_threadsafe(invoker.summarize(messages, summary), loop).result()
+    prepared = await asyncio.to_thread(prepare_message, invoker, user_id, session_id, input_message, summarize)
+    if prepared is None:
+        return jsonify({"error": "ERROR: Chat session not found"}), 404
+    settings, messages = prepared
+    response = await invoker.message_invoke(messages, temp=settings["temp"])
+    if not response.ok:
+        return jsonify({"error": str(response)}), response.error.http_status
+    await asyncio.to_thread(store_message, user_id, session_id, "assistant", response)
+    return jsonify({"user": input_message, "assistant": response})
+
+def prepare_message(invoker: BaseInvoker, user_id: int, session_id: int, input_message: str, summarize: Callable) -> Optional[tuple[dict, list[dict]]]:
+    '''
+        Store the user message and build the context of the turn, None if the user has no such chat
+    '''
+    # the worker threads are not request threads, their connection goes back to the pool here instead of in teardown_appcontext
+    try:
+        settings = get_chat_settings(user_id, session_id)
+        if settings is None:
+            return None
+        get_database().execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (user_id, session_id, "user", input_message))
+        with Metrics.timed("prompt"):
+            return settings, get_context_messages(invoker, user_id, session_id, summarize)
+    finally:
+        get_database().release()
+
+def store_message(user_id: int, session_id: int, role: str, content: str):
+    try:
+        get_database().execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (user_id, session_id, role, content))
+    finally:
+        get_database().release()
+
+@app.route("/api/search", methods=["GET"])
+def api_search():
+    '''
+        Search the messages of the user as JSON
+            query parameters: q (search text), page (1 by default), limit (1 to 100, 20 by default)
+    '''
+    if not session.get("logged_in", False):
+        return jsonify({"error": "ERROR: Please login first"}), 401
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify({"error": "ERROR: Empty search"}), 400
+    page = max(request.args.get("page", 1, type=int), 1)
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    results, has_next = get_search_page(session["user_id"], text, page, limit)
+    return jsonify({"results": results, "page": page, "has_next": has_next})
 
 @app.route("/chat/history", methods=["GET"])
 def show_history():
     if not session.get("logged_in", False):
         flash("ERROR: Please login first")
         return redirect("/login")
-    db = get_database()
-    sessions = db.execute("SELECT * FROM chat_sessions WHERE user_id = ? ORDER BY session_created_at DESC", (session["user_id"],), fetchall=True)
-    return render_template("history.html", sessions=sessions)
+    text = request.args.get("q", "").strip()
+    if text:
+        page = max(request.args.get("page", 1, type=int), 1)
+        results, has_next = get_search_page(session["user_id"], text, page)
+        return render_template("History.html", query=text, results=results, page=page, has_next=has_next)
+    sessions, next_before = get_session_page(session["user_id"], request.args.get("before", type=int))
+    return render_template("History.html", sessions=sessions, next_before=next_before, first_page="before" not in request.args)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    '''
+        Export the metrics of this process in the Prometheus text format
+    '''
+    return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/logout", methods=["GET"])
 def logout():
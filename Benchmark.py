@@ -0,0 +1,457 @@
+import os
+import sys
+import time
+import subprocess
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import json
+import math
+import random
+import itertools
+from Database import Database
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+    备注：
+    性能测试脚本，每个子命令测试一个方面，所有测试都在临时目录中进行，不会影响Data.db
+    使用方法：python Benchmark.py <子命令> [参数]
+'''
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Schema.sql")
+
+def create_temp_database(db_name: str = "Benchmark.db") -> Database:
+    '''
+        Create a fresh database in a temporary directory
+    '''
+    return Database(os.path.join(tempfile.mkdtemp(), db_name), SCHEMA_PATH)
+
+def run_threads(target, threads: int, *args):
+    '''
+        Run the target in the given number of threads and wait for all of them
+    '''
+    workers = [threading.Thread(target=target, args=args) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def report(name: str, operations: int, seconds: float):
+    print(f"{name:<32} {operations:>10} ops {seconds:>8.3f} s {operations / seconds:>12.1f} ops/s")
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+        Nearest-rank percentile of the values, p between 0 and 100
+    '''
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] if ordered else 0.0
+
+def import_app():
+    '''
+        Import App in a temporary working directory, App opens Data.db and Schema.sql in the working directory
+    '''
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.chdir(tempfile.mkdtemp())
+    shutil.copy(SCHEMA_PATH, "Schema.sql")
+    import App
+    return App
+
+def benchmark_db(args):
+    '''
+        Compare connect-per-query (the previous behaviour) with the pooled connections
+    '''
+    db = create_temp_database()
+    db.execute("INSERT INTO users (username) VALUES (?)", ("benchmark",))
+    db.execute("INSERT INTO chat_sessions (user_id, session_role, session_title, temp, session_created_at) VALUES (?, ?, ?, ?, ?)", (1, "role", "title", 1.0, "2025-01-01 00:00:00"))
+    for i in range(args.messages):
+        db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (1, 1, "user" if i % 2 == 0 else "assistant", f"message {i}"))
+    query = "SELECT message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? ORDER BY message_id ASC"
+    per_thread = args.queries // args.threads
+
+    def connect_per_query():
+        for _ in range(per_thread):
+            with sqlite3.connect(db.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                conn.execute(query, (1, 1)).fetchall()
+            conn.close()
+
+    def construct_per_request():
+        for _ in range(per_thread):
+            Database(db.db_path, SCHEMA_PATH).execute(query, (1, 1), fetchall=True)
+
+    def pooled():
+        for _ in range(per_thread):
+            db.execute(query, (1, 1), fetchall=True)
+
+    operations = per_thread * args.threads
+    for name, target in [("connect per query", connect_per_query), ("Database per request", construct_per_request), ("pooled singleton", pooled)]:
+        start = time.perf_counter()
+        run_threads(target, args.threads)
+        report(name, operations, time.perf_counter() - start)
+
+def benchmark_sessions(args):
+    '''
+        Create chat sessions in parallel through the /chat/create route and verify that
+        every session got its own id and exactly its own system message
+    '''
+    App = import_app()
+    db = App.get_database()
+    per_thread = args.sessions // args.threads
+    created = []
+    created_lock = threading.Lock()
+
+    def create_sessions(user_id: int):
+        client = App.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session["logged_in"] = True
+            flask_session["user_id"] = user_id
+        for i in range(per_thread):
+            role = f"role {user_id} {i}"
+            response = client.post("/chat/create", data={"chat_partner": role, "personality": "1.0", "chat_topic": "benchmark"})
+            with created_lock:
+                created.append((int(response.location.rsplit("/", 1)[1]), user_id, role))
+
+    for user_id in range(1, args.threads + 1):
+        db.execute("INSERT INTO users (username) VALUES (?)", (f"user {user_id}",))
+    start = time.perf_counter()
+    workers = [threading.Thread(target=create_sessions, args=(user_id,)) for user_id in range(1, args.threads + 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    report("create chat sessions", len(created), time.perf_counter() - start)
+
+    # verify the sessions
+    rows = db.execute("SELECT s.session_id, s.user_id, s.session_role, m.message_content, m.user_id AS message_user_id FROM chat_sessions s JOIN messages m ON m.session_id = s.session_id AND m.message_role = 'system'", fetchall=True)
+    stored = {row["session_id"]: (row["user_id"], row["session_role"]) for row in rows if row["message_content"] == row["session_role"] and row["message_user_id"] == row["user_id"]}
+    errors = len({session_id for session_id, _, _ in created}) != len(created)
+    errors = errors or len(rows) != len(created) or any(stored.get(session_id) != (user_id, role) for session_id, user_id, role in created)
+    print("verification:", "FAILED" if errors else "OK")
+    if errors:
+        raise SystemExit(1)
+
+def benchmark_bulk(args):
+    '''
+        rows/sec of the transcript import (executemany in large transactions) and export (streamed reads)
+    '''
+    from Transcript import export_transcripts, import_transcripts
+    db = create_temp_database()
+    user_id = db.insert("INSERT INTO users (username) VALUES (?)", ("benchmark",))
+    directory = os.path.dirname(db.db_path)
+    source = os.path.join(directory, "source.jsonl")
+    with open(source, "w", encoding="utf-8") as f:
+        for i in range(args.messages):
+            if i % args.session_size == 0:
+                f.write(json.dumps({"type": "session", "session_id": i // args.session_size, "title": "benchmark", "role": "assistant", "temp": 1.0}) + "\n")
+            f.write(json.dumps({"type": "message", "session_id": i // args.session_size, "role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " * 8}) + "\n")
+
+    start = time.perf_counter()
+    with open(source, "r", encoding="utf-8") as f:
+        count = import_transcripts(db, user_id, f, args.batch_size)
+    report("import messages", count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with open(os.path.join(directory, "export.jsonl"), "w", encoding="utf-8") as f:
+        count = export_transcripts(db, user_id, f)
+    report("export messages", count, time.perf_counter() - start)
+
+    # the previous behaviour for comparison: one committed INSERT per message
+    rows = min(args.messages, 20000)
+    start = time.perf_counter()
+    for i in range(rows):
+        db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (user_id, 1, "user", f"message {i} " * 8))
+    report("insert one by one", rows, time.perf_counter() - start)
+
+def benchmark_search(args):
+    '''
+        queries/sec of the full-text search on a large corpus, compared with a LIKE scan
+    '''
+    db = create_temp_database()
+    rng = random.Random(0)
+    # Zipf-like vocabulary: a few very common words and a long tail of rare ones
+    vocabulary = [f"word{i}" for i in range(args.vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(args.vocabulary)))
+    # a share of the messages is Chinese: two-character words written without spaces, clauses separated by punctuation
+    characters = [chr(0x4e00 + i) for i in range(3000)]
+    chinese_vocabulary = [characters[i % 3000] + characters[(i * 7 + 1) % 3000] for i in range(args.vocabulary)]
+
+    def chinese_message() -> str:
+        words = rng.choices(chinese_vocabulary, cum_weights=cum_weights, k=args.words)
+        return "，".join("".join(words[i:i + 5]) for i in range(0, len(words), 5)) + "。"
+    with db.transaction():
+        db.execute_many("INSERT INTO users (username) VALUES (?)", [(f"user {i}",) for i in range(args.users)])
+        db.execute_many("INSERT INTO chat_sessions (user_id, session_role, session_title, temp, session_created_at) VALUES (?, ?, ?, ?, ?)", [(i % args.users + 1, "assistant", f"session {i}", 1.0, "2025-01-01 00:00:00") for i in range(args.messages // args.session_size + 1)])
+    seconds = 0.0
+    for offset in range(0, args.messages, args.batch_size):
+        rows = []
+        for i in range(offset, min(offset + args.batch_size, args.messages)):
+            session_id = i // args.session_size + 1
+            content = chinese_message() if rng.random() < args.chinese else " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=args.words))
+            rows.append(((session_id - 1) % args.users + 1, session_id, "user" if i % 2 == 0 else "assistant", content))
+        # only the insert is timed, not the generation of the corpus
+        start = time.perf_counter()
+        with db.transaction():
+            db.execute_many("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", rows)
+        seconds += time.perf_counter() - start
+    report("insert and index messages", args.messages, seconds)
+
+    # words inside a Chinese sentence must be found, not only whole clauses
+    db.execute("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", (1, 1, "user", "你好，我叫小鹏。我叫什么名字？"))
+    for text in ["名字", "小鹏", "我叫什么名字"]:
+        print(f"chinese check {text}: {'found' if db.search_messages(1, text) else 'NOT FOUND'}")
+
+    searches = [("common word", "word1"), ("rare word", f"word{args.vocabulary - 1}"), ("two words", "word3 word40"), ("prefix", "word99*"),
+                ("chinese common word", chinese_vocabulary[1]), ("chinese rare word", chinese_vocabulary[-1]), ("chinese two words", f"{chinese_vocabulary[3]} {chinese_vocabulary[40]}")]
+    for name, text in searches:
+        start = time.perf_counter()
+        for i in range(args.queries):
+            db.search_messages(i % args.users + 1, text, limit=20)
+        report(f"search {name}", args.queries, time.perf_counter() - start)
+
+    # the alternative without the index: a LIKE scan over the messages of the user
+    queries = max(args.queries // 100, 1)
+    start = time.perf_counter()
+    for i in range(queries):
+        db.execute("SELECT message_id FROM messages WHERE user_id = ? AND message_content LIKE ? LIMIT 20", (i % args.users + 1, f"%word{args.vocabulary - 1} %"), fetchall=True)
+    report("LIKE scan rare word", queries, time.perf_counter() - start)
+
+def benchmark_load(args):
+    '''
+        Drive register -> login -> create chat -> N turns for many simulated users through the routes of App,
+        against the mock server (or the server at --base-url), and report the latency percentiles per step,
+        requests/sec and database statements per turn
+    '''
+    if args.base_url:
+        os.environ["DEEPSEEK_BASE_URL"] = args.base_url
+    else:
+        from MockServer import create_server
+        server = create_server("127.0.0.1", 0, args.latency, args.token_latency, args.error_rate, jitter=args.jitter)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        os.environ["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    App = import_app()
+    import Metrics
+    # step -> latencies in seconds
+    latencies = {"login": [], "create": [], "turn": []}
+    failures = {"login": 0, "create": 0, "turn": 0}
+    lock = threading.Lock()
+
+    def timed(step: str, send, check) -> tuple[bool, object]:
+        '''
+            Send the request, record its latency and whether check(response) passed
+        '''
+        start = time.perf_counter()
+        response = send()
+        # the streamed body is read here, so the latency of a turn covers the whole reply
+        ok = check(response)
+        seconds = time.perf_counter() - start
+        with lock:
+            latencies[step].append(seconds)
+            failures[step] += 0 if ok else 1
+        return ok, response
+
+    def simulate(user: int):
+        client = App.app.test_client()
+        username = f"load {user}"
+        client.post("/register", data={"username": username})
+        ok, _ = timed("login", lambda: client.post("/login", data={"username": username, "api_key": "benchmark"}), lambda response: response.location == "/chat")
+        if not ok:
+            return
+        ok, response = timed("create", lambda: client.post("/chat/create", data={"chat_partner": "You are a helpful assistant", "personality": "1.0", "chat_topic": "load"}), lambda response: "/chat/create" not in response.location)
+        if not ok:
+            return
+        session_id = int(response.location.rsplit("/", 1)[1])
+        for turn in range(args.turns):
+            message = f"turn {turn} of user {user} " + "words " * args.words
+            if args.mode == "stream":
+                # the browser streams the reply and does not reload the page
+                timed("turn", lambda: client.post(f"/chat/{session_id}/stream", data={"message": message}), lambda response: "event: done" in response.get_data(as_text=True))
+            else:
+                # the form falls back to POST, redirect and GET of the page, a failure is flashed above the script (which contains the same text)
+                timed("turn", lambda: client.post(f"/chat/{session_id}", data={"message": message}, follow_redirects=True), lambda response: "ERROR: Failed to invoke API" not in response.get_data(as_text=True).split("<script>")[0])
+
+    db_statements = Metrics.db_query_seconds.total()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(simulate, range(args.users)))
+    seconds = time.perf_counter() - start
+    db_statements = Metrics.db_query_seconds.total() - db_statements
+
+    requests = sum(len(values) for values in latencies.values())
+    print(f"{'step':<8} {'count':>7} {'failed':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, values in latencies.items():
+        print(f"{step:<8} {len(values):>7} {failures[step]:>7} " + " ".join(f"{percentile(values, p) * 1000:>9.1f}" for p in (50, 95, 99, 100)))
+    report("requests", requests, seconds)
+    turns = len(latencies["turn"])
+    if turns:
+        # register, login and create statements are included, so this is an upper bound for long chats
+        print(f"db statements per turn: {db_statements / turns:.1f}")
+
+def benchmark_route(args):
+    '''
+        Send completions through Invoker to a pool of mock servers (fast, slow, and fast but failing),
+        the fast one becomes slow halfway through, and compare the latencies and failures of
+            1. single: every request to the fast server, like an Invoker without a router
+            2. weighted: the first endpoint picked at random by weight, with failover
+            3. router: the latency-aware routing
+    '''
+    from MockServer import create_server
+    from Invoker import Invoker, Router, Endpoint, load_openai
+    import Metrics
+    # the first requests would wait for the import of the SDK
+    load_openai()
+    # name -> (latency, jitter, error rate)
+    pool = {"fast": (args.latency, args.latency / 2, 0.0), "slow": (args.latency * 4, args.latency / 2, 0.0), "flaky": (args.latency / 2, args.latency / 4, args.error_rate)}
+    messages = [{"role": "user", "content": "route " + "words " * 20}]
+    print(f"{'strategy':<9} {'failed':>7} {'before p50':>11} {'before p95':>11} {'after p50':>10} {'after p95':>10} {'p99 ms':>8}  requests per endpoint (fast/slow/flaky)")
+    for strategy in ("single", "weighted", "router"):
+        servers = {}
+        for name, (latency, jitter, error_rate) in pool.items():
+            servers[name] = create_server("127.0.0.1", 0, latency, error_rate=error_rate, jitter=jitter)
+            threading.Thread(target=servers[name].serve_forever, daemon=True).start()
+        urls = {name: f"http://127.0.0.1:{server.server_address[1]}" for name, server in servers.items()}
+        # explore=1.0 always puts an endpoint picked by weight first
+        router = Router([Endpoint(url, Invoker.model) for url in urls.values()], explore=1.0 if strategy == "weighted" else 0.05)
+        # before and after the fast server degrades
+        latencies = ([], [])
+        failures = 0
+        lock = threading.Lock()
+
+        def send(index: int):
+            nonlocal failures
+            if index == args.requests // 2:
+                # the fast server degrades, e.g. a region under load
+                servers["fast"].RequestHandlerClass.latency = args.latency * 10
+            invoker = Invoker("benchmark", base_url=urls["fast"], router=router if strategy != "single" else None)
+            start = time.perf_counter()
+            result = invoker.message_invoke(messages, max=16)
+            seconds = time.perf_counter() - start
+            with lock:
+                latencies[index >= args.requests // 2].append(seconds)
+                failures += 0 if result.ok else 1
+
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(send, range(args.requests)))
+        shares = [Metrics.upstream_endpoint_requests.value(endpoint=url, model=Invoker.model, outcome="ok") for url in urls.values()]
+        before, after = latencies
+        print(f"{strategy:<9} {failures:>7} {percentile(before, 50) * 1000:>11.1f} {percentile(before, 95) * 1000:>11.1f} {percentile(after, 50) * 1000:>10.1f} {percentile(after, 95) * 1000:>10.1f} {percentile(before + after, 99) * 1000:>8.1f}  " + "/".join(str(int(share)) for share in shares))
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+
+STARTUP_SCRIPT = '''
+import os, sys, json, time
+start = time.perf_counter()
+import Server
+app = Server.create_app(preload_sdk=sys.argv[1] == "preload")
+startup = time.perf_counter() - start
+
+def memory():
+    # kB of the process: Rss, and the Private pages that are not shared with the master after fork
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Private_Clean:", "Private_Dirty:"):
+                values[parts[0][:-1]] = int(parts[1])
+    return {"rss": values["Rss"], "private": values["Private_Clean"] + values["Private_Dirty"]}
+
+master = memory()
+read, write = os.pipe()
+if os.fork() == 0:
+    # a worker serving a first chat: login (API key check), create a chat and one turn
+    client = app.test_client()
+    client.post("/register", data={"username": "startup"})
+    client.post("/login", data={"username": "startup", "api_key": "startup"})
+    client.post("/chat/create", data={"chat_partner": "assistant", "personality": "1.0", "chat_topic": "startup"})
+    first = time.perf_counter()
+    client.post("/chat/1/stream", data={"message": "hello"}).get_data()
+    worker = memory()
+    worker["first_turn"] = time.perf_counter() - first
+    os.write(write, json.dumps(worker).encode())
+    os._exit(0)
+os.wait()
+print(json.dumps({"startup": startup, "master": master, "worker": json.loads(os.read(read, 65536))}))
+'''
+
+def benchmark_startup(args):
+    '''
+        Startup time and memory of a process running Server.create_app(), and the memory of a forked worker
+        after its first chat, with the OpenAI SDK imported lazily (the default) or preloaded in the master
+    '''
+    from MockServer import create_server
+    server = create_server("127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = dict(os.environ, SECRET_KEY="benchmark", DEEPSEEK_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}", PYTHONPATH=os.path.dirname(SCHEMA_PATH))
+    env.pop("PRELOAD_SDK", None)
+    print(f"{'mode':<10} {'startup s':>10} {'master RSS MB':>14} {'worker RSS MB':>14} {'worker private MB':>18} {'first turn s':>13}")
+    for mode in ("lazy", "preload"):
+        results = []
+        for _ in range(args.runs):
+            # a fresh database and interpreter for every run
+            directory = tempfile.mkdtemp()
+            shutil.copy(SCHEMA_PATH, directory)
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, mode], cwd=directory, env=env, capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output))
+        median = lambda values: sorted(values)[len(values) // 2]
+        print(f"{mode:<10} {median([r['startup'] for r in results]):>10.3f} {median([r['master']['rss'] for r in results]) / 1024:>14.1f} {median([r['worker']['rss'] for r in results]) / 1024:>14.1f} {median([r['worker']['private'] for r in results]) / 1024:>18.1f} {median([r['worker']['first_turn'] for r in results]):>13.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Deepseek Invoker Web")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    db_parser = subparsers.add_parser("db", help="queries/sec of the database layer")
+    db_parser.add_argument("--queries", type=int, default=20000)
+    db_parser.add_argument("--threads", type=int, default=4)
+    db_parser.add_argument("--messages", type=int, default=20, help="messages in the benchmarked session")
+    db_parser.set_defaults(func=benchmark_db)
+
+    sessions_parser = subparsers.add_parser("sessions", help="create chat sessions in parallel and verify them")
+    sessions_parser.add_argument("--sessions", type=int, default=2000)
+    sessions_parser.add_argument("--threads", type=int, default=16)
+    sessions_parser.set_defaults(func=benchmark_sessions)
+
+    bulk_parser = subparsers.add_parser("bulk", help="rows/sec of the transcript import and export")
+    bulk_parser.add_argument("--messages", type=int, default=1000000)
+    bulk_parser.add_argument("--session-size", type=int, default=100, help="messages per chat session")
+    bulk_parser.add_argument("--batch-size", type=int, default=50000, help="messages per transaction")
+    bulk_parser.set_defaults(func=benchmark_bulk)
+
+    search_parser = subparsers.add_parser("search", help="queries/sec of the full-text search")
+    search_parser.add_argument("--messages", type=int, default=2000000)
+    search_parser.add_argument("--users", type=int, default=100)
+    search_parser.add_argument("--session-size", type=int, default=100, help="messages per chat session")
+    search_parser.add_argument("--words", type=int, default=30, help="words per message")
+    search_parser.add_argument("--vocabulary", type=int, default=50000)
+    search_parser.add_argument("--chinese", type=float, default=0.25, help="share of Chinese messages")
+    search_parser.add_argument("--queries", type=int, default=1000)
+    search_parser.add_argument("--batch-size", type=int, default=50000, help="messages per transaction")
+    search_parser.set_defaults(func=benchmark_search)
+
+    load_parser = subparsers.add_parser("load", help="latency percentiles of simulated users chatting against the mock server")
+    load_parser.add_argument("--users", type=int, default=50)
+    load_parser.add_argument("--turns", type=int, default=5, help="messages sent by every user")
+    load_parser.add_argument("--concurrency", type=int, default=16, help="users simulated at the same time")
+    load_parser.add_argument("--mode", choices=["stream", "form"], default="stream", help="send the messages with the streaming route or the form POST")
+    load_parser.add_argument("--words", type=int, default=20, help="words per message")
+    load_parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token of the mock server")
+    load_parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between the streamed tokens of the mock server")
+    load_parser.add_argument("--jitter", type=float, default=0.05, help="random extra latency of the mock server")
+    load_parser.add_argument("--error-rate", type=float, default=0.0, help="error probability of the mock server")
+    load_parser.add_argument("--base-url", help="use this OpenAI-compatible server instead of the mock server")
+    load_parser.set_defaults(func=benchmark_load)
+
+    route_parser = subparsers.add_parser("route", help="latencies of the routing over several mock servers, one of them degrading")
+    route_parser.add_argument("--requests", type=int, default=2000)
+    route_parser.add_argument("--concurrency", type=int, default=16)
+    route_parser.add_argument("--latency", type=float, default=0.03, help="seconds of the fast mock server, the slow one takes 4 times as long")
+    route_parser.add_argument("--error-rate", type=float, default=0.3, help="error probability of the flaky mock server")
+    route_parser.set_defaults(func=benchmark_route)
+
+    startup_parser = subparsers.add_parser("startup", help="startup time and memory per worker of the production entry point")
+    startup_parser.add_argument("--runs", type=int, default=5, help="runs per mode, the median is reported")
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    args = parser.parse_args()
+    args.func(args)
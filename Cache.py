@@ -0,0 +1,265 @@
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from Database import Database
+
+class LRUCache:
+    '''
+        Thread-safe LRU cache bounded by the number of entries and optionally by the total weight
+            1. weigher(value) returns the weight of a value, 1 by default
+            2. ttl is the lifetime of an entry in seconds, None means no expiration
+    '''
+    def __init__(self, max_entries: int = 1024, max_weight: Optional[int] = None, ttl: Optional[float] = None, weigher: Optional[Callable[[Any], int]] = None):
+        if max_entries <= 0:
+            raise ValueError("ERROR: max_entries must be positive")
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.weigher = weigher if weigher else (lambda value: 1)
+        '''
+            备注：
+            OrderedDict记录插入/访问顺序，move_to_end将最近访问的条目移动到末尾，淘汰时从头部删除最久未访问的条目
+            每个条目保存为(value, weight, expires_at)
+        '''
+        self._entries = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expired(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _remove(self, key):
+        _, weight, _ = self._entries.pop(key)
+        self._weight -= weight
+
+    def get(self, key, default = None):
+        '''
+            Get the value of the key and mark it as recently used, count a hit or a miss
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[2]):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default = None):
+        '''
+            Get the value of the key without touching the LRU order or the counters
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[2]):
+                return default
+            return entry[0]
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        '''
+            Put the value and evict the least recently used entries if the cache is over its bounds
+                a value heavier than max_weight is not cached
+        '''
+        weight = self.weigher(value)
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self._entries[key] = (value, weight, expires_at)
+            self._weight += weight
+            while len(self._entries) > self.max_entries or (self.max_weight is not None and self._weight > self.max_weight):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key, default = None):
+        '''
+            Remove the key and return its value
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return default if self._expired(entry[2]) else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def stats(self) -> dict:
+        '''
+            Get the counters of the cache
+        '''
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "weight": self._weight,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class MessageCache:
+    '''
+        Materialized message lists of chat sessions, keyed by (user_id, session_id)
+            each entry is (last_message_id, messages, message_ids), only the messages newer than
+            last_message_id are read from the database when the session is requested again
+    '''
+    def __init__(self, db: Database, max_sessions: int = 1024, max_chars: int = 32000000):
+        self.db = db
+        self.cache = LRUCache(max_sessions, max_chars, weigher=self._weigh)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _weigh(entry: tuple) -> int:
+        # approximate the memory by the content length plus a fixed overhead per message
+        return sum(len(message["content"]) + 64 for message in entry[1])
+
+    def get_messages(self, user_id: int, session_id: int, with_ids: bool = False):
+        '''
+            Get the message list of the session, in the format of the chat completions API
+                return (messages, message_ids) if with_ids is True
+        '''
+        key = (user_id, session_id)
+        entry = self.cache.get(key)
+        last_id = entry[0] if entry else 0
+        rows = self.db.execute("SELECT message_id, message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? AND message_id > ? ORDER BY message_id ASC", (user_id, session_id, last_id), fetchall=True)
+        if rows:
+            with self._lock:
+                # another thread may have synchronized the session in the meantime
+                current = self.cache.peek(key)
+                base = current if current and current[0] >= last_id else (entry or (0, (), ()))
+                messages = list(base[1])
+                ids = list(base[2])
+                for row in rows:
+                    if row["message_id"] > base[0]:
+                        messages.append({"role": row["message_role"], "content": row["message_content"]})
+                        ids.append(row["message_id"])
+                entry = (max(base[0], rows[-1]["message_id"]), tuple(messages), tuple(ids))
+                self.cache.put(key, entry)
+        elif not entry:
+            entry = (0, (), ())
+        if with_ids:
+            return list(entry[1]), list(entry[2])
+        return list(entry[1])
+
+    def invalidate(self, user_id: int, session_id: int):
+        self.cache.pop((user_id, session_id))
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+class ResponseCache:
+    '''
+        Responses of deterministic invocations, keyed by a hash of (base url, model, messages, temperature, max_tokens)
+            1. the memory tier is an LRUCache, the optional persistent tier is the response_cache table of the database
+            2. entries expire after ttl seconds, the persistent tier keeps at most max_rows rows
+            3. concurrent requests of the same key are coalesced, only the first one invokes the API
+            4. failures are never cached, create() raises instead of returning a response
+            5. only invocations at temperature 0 are cached unless cache_nonzero_temperature is True,
+               otherwise every caller of a prompt would get the same sample
+    '''
+    def __init__(self, max_entries: int = 4096, ttl: Optional[float] = 3600.0, db: Optional[Database] = None, max_rows: int = 100000, cache_nonzero_temperature: bool = False):
+        self.ttl = ttl
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+        self.db = db
+        self.max_rows = max_rows
+        self.memory = LRUCache(max_entries, ttl=ttl)
+        self.persistent_hits = 0
+        self.coalesced = 0
+        # key -> (event set when the response is ready, [response, exception])
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @staticmethod
+    def key(base_url: str, model: str, messages: list[dict], temperature: float, max_tokens: int) -> str:
+        payload = json.dumps([base_url, model, messages, temperature, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, temperature: float) -> bool:
+        return temperature == 0 or self.cache_nonzero_temperature
+
+    def get(self, key: str) -> Optional[str]:
+        '''
+            Get the cached response from the memory tier, then from the persistent tier
+        '''
+        response = self.memory.get(key)
+        if response is not None or self.db is None:
+            return response
+        row = self.db.execute("SELECT response, created_at FROM response_cache WHERE cache_key = ?", (key,), fetchone=True)
+        if not row or (self.ttl is not None and row["created_at"] + self.ttl <= time.time()):
+            return None
+        self.persistent_hits += 1
+        # the entry expires in memory when it expires in the database, not ttl seconds after it was read
+        self.memory.put(key, row["response"], ttl=row["created_at"] + self.ttl - time.time() if self.ttl is not None else None)
+        return row["response"]
+
+    def put(self, key: str, response: str):
+        self.memory.put(key, response)
+        if self.db is None:
+            return
+        self.db.execute("INSERT OR REPLACE INTO response_cache (cache_key, response, created_at) VALUES (?, ?, ?)", (key, response, time.time()))
+        # trim the persistent tier once every 100 writes
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % 100 == 0
+        if trim:
+            self.db.execute("DELETE FROM response_cache WHERE created_at <= ?", (time.time() - self.ttl if self.ttl is not None else 0,))
+            self.db.execute("DELETE FROM response_cache WHERE cache_key IN (SELECT cache_key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+
+    def get_or_create(self, key: str, create: Callable[[], str]) -> str:
+        '''
+            Get the cached response, or call create() once for all the concurrent requests of the key
+                the exception of create() is raised in all the concurrent requests
+        '''
+        response = self.get(key)
+        if response is not None:
+            return response
+        with self._lock:
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = (threading.Event(), [None, None])
+                self._inflight[key] = inflight
+        if not leader:
+            self.coalesced += 1
+            inflight[0].wait()
+            if inflight[1][1] is not None:
+                raise inflight[1][1]
+            return inflight[1][0]
+        try:
+            response = create()
+            inflight[1][0] = response
+            self.put(key, response)
+            return response
+        except Exception as e:
+            inflight[1][1] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            inflight[0].set()
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["persistent_hits"] = self.persistent_hits
+        stats["coalesced"] = self.coalesced
+        return stats
+
@@ -1,14 +1,250 @@
 import os
+import re
+import time
 import sqlite3
-from typing import Optional
+import threading
+import Metrics
+from contextlib import contextmanager, nullcontext
+from itertools import groupby
+from typing import Iterable, Iterator, Optional
+
+# Chinese, Japanese and Korean characters, written without spaces between the words
+CJK_CHARACTER = re.compile("([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0003134f])")
 
 class Database:
+
+    # tuned for a read-heavy web workload, applied to every pooled connection
+    pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY"
+    }
+
+    '''
+        备注：
+        数据库结构的版本号保存在PRAGMA user_version中，Schema.sql总是创建最新版本的结构
+        已存在的数据库在启动时按顺序执行尚未执行的迁移，migrations[i]将版本从i升级到i+1
+    '''
+    migrations = [
+        # 1: summary and start of the context window of a chat session
+        [
+            "ALTER TABLE chat_sessions ADD COLUMN session_summary TEXT",
+            "ALTER TABLE chat_sessions ADD COLUMN context_start_id INTEGER NOT NULL DEFAULT 0"
+        ],
+        # 2: persistent tier of the response cache
+        [
+            "CREATE TABLE response_cache (cache_key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)",
+            "CREATE INDEX idx_response_cache_created ON response_cache (created_at)"
+        ],
+        # 3: message count and last activity of a chat session maintained by triggers, keyset index of the history
+        [
+            "ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE chat_sessions ADD COLUMN last_activity_at TEXT",
+            "UPDATE chat_sessions SET message_count = (SELECT COUNT(*) FROM messages WHERE messages.session_id = chat_sessions.session_id AND message_role != 'system'), last_activity_at = session_created_at",
+            "DROP INDEX idx_chat_sessions_user_created",
+            "CREATE INDEX idx_chat_sessions_user_created ON chat_sessions (user_id, session_created_at DESC, session_id DESC)",
+            """CREATE TRIGGER trg_messages_insert_summary AFTER INSERT ON messages WHEN NEW.message_role != 'system'
+            BEGIN
+                UPDATE chat_sessions SET message_count = message_count + 1, last_activity_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime') WHERE session_id = NEW.session_id;
+            END""",
+            """CREATE TRIGGER trg_messages_delete_summary AFTER DELETE ON messages WHEN OLD.message_role != 'system'
+            BEGIN
+                UPDATE chat_sessions SET message_count = message_count - 1 WHERE session_id = OLD.session_id;
+            END"""
+        ],
+        # 4: full-text index of the messages, filled from the existing messages
+        [
+            "CREATE VIRTUAL TABLE messages_fts USING fts5 (user_id, message_content, content = 'messages', content_rowid = 'message_id', tokenize = 'unicode61 remove_diacritics 2')",
+            "INSERT INTO messages_fts (rowid, user_id, message_content) SELECT message_id, user_id, message_content FROM messages WHERE message_role != 'system'",
+            """CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages WHEN NEW.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, NEW.message_content);
+            END""",
+            """CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages WHEN OLD.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, OLD.message_content);
+            END""",
+            """CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF user_id, message_content ON messages WHEN NEW.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, OLD.message_content);
+                INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, NEW.message_content);
+            END"""
+        ],
+        # 5: server-side sessions of the browsers
+        [
+            "CREATE TABLE web_sessions (session_key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)",
+            "CREATE INDEX idx_web_sessions_expires ON web_sessions (expires_at)"
+        ],
+        # 6: CJK text indexed per character, the index reads the messages through a view that separates the characters
+        [
+            "DROP TRIGGER trg_messages_fts_insert",
+            "DROP TRIGGER trg_messages_fts_delete",
+            "DROP TRIGGER trg_messages_fts_update",
+            "DROP TABLE messages_fts",
+            "CREATE VIEW messages_fts_content AS SELECT message_id, user_id, fts_text(message_content) AS message_content FROM messages WHERE message_role != 'system'",
+            "CREATE VIRTUAL TABLE messages_fts USING fts5 (user_id, message_content, content = 'messages_fts_content', content_rowid = 'message_id', tokenize = 'unicode61 remove_diacritics 2')",
+            "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+            """CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages WHEN NEW.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, fts_text(NEW.message_content));
+            END""",
+            """CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages WHEN OLD.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, fts_text(OLD.message_content));
+            END""",
+            """CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF user_id, message_content ON messages WHEN NEW.message_role != 'system'
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, fts_text(OLD.message_content));
+                INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, fts_text(NEW.message_content));
+            END"""
+        ],
+        # 7: the API keys are encrypted in the sessions, the sessions stored with a plaintext key are deleted (their users login again)
+        [
+            "DELETE FROM web_sessions"
+        ]
+    ]
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # connections kept open by release() for the next thread
+    max_idle = 16
+
     def __init__(self, db_path = "Data.db", schema_path = "Schema.sql"):
         self.db_path = db_path
         self.schema_path = schema_path
         if not self.db_path or not self.schema_path:
             raise ValueError("ERROR: Database path or schema path is not set")
+        '''
+            备注：
+            每个线程在第一次执行语句时取得一个连接（threading.local），之后的语句都使用它，同一时刻只有一个线程使用一个连接
+            1. release()（在请求结束时调用）把连接放回空闲池，下一个线程直接取用，不必重新打开
+            2. 连接只被它的线程引用，线程结束时（例如每个请求一个线程的服务器、异步视图的事件循环线程）连接随之关闭
+        '''
+        self._local = threading.local()
+        self._idle = []
+        self._idle_lock = threading.Lock()
         self._init_database()
+
+    @classmethod
+    def instance(cls, db_path = "Data.db", schema_path = "Schema.sql") -> "Database":
+        '''
+            Get the process-wide Database for the given path
+                the schema is validated only once, when the instance is created
+        '''
+        key = os.path.abspath(db_path)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(db_path, schema_path)
+            return cls._instances[key]
+
+    def _connect(self) -> sqlite3.Connection:
+        '''
+            Get the connection of the current thread, take an idle one or open a new one if it has none
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                # the connection moves between threads through the idle pool, but it is used by one thread at a time
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                # used by the full-text index of the messages, see fts_text()
+                conn.create_function("fts_text", 1, self.fts_text, deterministic=True)
+                for name, value in self.pragmas.items():
+                    conn.execute(f"PRAGMA {name} = {value}")
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        '''
+            Give up the connection of the current thread, e.g. at the end of a request
+                it is kept for the next thread if fewer than max_idle connections are idle, otherwise it is closed
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "in_transaction", False):
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._idle_lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _scope(self):
+        '''
+            Get the transaction scope of a statement
+                the statement joins the transaction() of the current thread if there is one,
+                otherwise it is committed on its own
+        '''
+        conn = self._connect()
+        return nullcontext(conn) if getattr(self._local, "in_transaction", False) else conn
+
+    @staticmethod
+    def _observe(operation: str, start: float, failed: bool = False):
+        '''
+            Record the latency of a statement in the metrics and in the timings of the current request
+        '''
+        seconds = time.perf_counter() - start
+        Metrics.db_query_seconds.observe(seconds, operation=operation)
+        Metrics.add_timing("db", seconds)
+        if failed:
+            Metrics.db_errors.inc(operation=operation)
+
+    @staticmethod
+    def _operation(query: str) -> str:
+        # the first keyword of the statement, e.g. SELECT or INSERT
+        return query.lstrip().split(None, 1)[0].upper()
+
+    @contextmanager
+    def transaction(self):
+        '''
+            Run several statements atomically on the connection of the current thread
+                1. execute(), insert() and execute_batch() called inside the with block join the transaction
+                2. commit at the end of the block, roll back if an exception is raised
+                3. a nested transaction() joins the outer one
+                4. raise RuntimeError if the transaction cannot begin (e.g. the database is locked) or commit
+        '''
+        if getattr(self._local, "in_transaction", False):
+            yield self
+            return
+        conn = self._connect()
+        # BEGIN IMMEDIATE takes the write lock at the beginning, so the transaction cannot fail halfway with SQLITE_BUSY
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            raise RuntimeError(f"ERROR: Failed to begin transaction: {str(e)}")
+        self._local.in_transaction = True
+        try:
+            yield self
+            try:
+                conn.commit()
+            except Exception as e:
+                raise RuntimeError(f"ERROR: Failed to commit transaction: {str(e)}")
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.in_transaction = False
+
+    def close(self):
+        '''
+            Close the idle connections and the connection of the current thread
+                the connections of the other threads are closed when they are released or when their threads end
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        with self._idle_lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+        self._local = threading.local()
     
     def _init_database(self):
         '''
@@ -18,6 +254,7 @@ class Database:
         '''
         if os.path.exists(self.db_path):
             self._test_connection()
+            self._migrate()
         else:
             self._create_database()
 
@@ -26,7 +263,8 @@ class Database:
             Test the connection to the database and verify all required tables exist
         '''
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            conn = self._connect()
+            with conn:
                 cursor = conn.cursor()
                 # Check if all required tables exist
                 required_tables = ['users', 'chat_sessions', 'messages']
@@ -42,12 +280,33 @@ class Database:
         except Exception as e:
             raise ConnectionError(f"ERROR: Failed to connect to the database: {str(e)}")
 
+    def _migrate(self) -> bool:
+        '''
+            Upgrade an existing database to the latest schema version
+        '''
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, so concurrent workers migrate only once
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i in range(version, len(self.migrations)):
+                for statement in self.migrations[i]:
+                    conn.execute(statement)
+            if version < len(self.migrations):
+                conn.execute(f"PRAGMA user_version = {len(self.migrations)}")
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            raise RuntimeError(f"ERROR: Failed to migrate database: {str(e)}")
+
     def _create_database(self) -> bool:
         '''
             create the database
         '''
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            conn = self._connect()
+            with conn:
                 with open(self.schema_path, "r", encoding="utf-8") as f:
                     schema = f.read()
                 conn.executescript(schema)
@@ -65,20 +324,20 @@ class Database:
         '''
         if not query:
             return False
+        start = time.perf_counter()
+        failed = False
         try:
             '''
                 备注：
-                此处的sqlite.connect返回一个Connection对象，是一个上下文管理器(@contextmanager)
+                Connection对象是一个上下文管理器(@contextmanager)
                 with语句开始，将会开始一个隐式事务
-                with语句结束，如果没有发生异常，将会自动提交事务；如果有异常，将会自动回滚事务；处理结束后自动关闭链接
+                with语句结束，如果没有发生异常，将会自动提交事务；如果有异常，将会自动回滚事务
+                注意：with语句不会关闭连接，连接由当前线程复用
             '''
-            with sqlite3.connect(self.db_path) as conn:
-                # set to row factory
-                conn.row_factory = sqlite3.Row
-
+            with self._scope() as conn:
                 # execute the query
                 cursor = conn.cursor()
-                cursor.execute(query, params)
+                cursor.execute(query, params or ())
 
                 # return result(s)
                 if fetchone:
@@ -87,22 +346,141 @@ class Database:
                     return cursor.fetchall()
                 return True
         except Exception as e:
+            failed = True
             raise RuntimeError(f"ERROR: Failed to execute query: {str(e)}")
+        finally:
+            self._observe(self._operation(query), start, failed)
+
+    def insert(self, query: str, params: Optional[tuple] = None) -> int:
+        '''
+            Execute an INSERT query and return the id of the inserted row
+        '''
+        if not query:
+            raise ValueError("ERROR: Empty query")
+        start = time.perf_counter()
+        failed = False
+        try:
+            with self._scope() as conn:
+                cursor = conn.execute(query, params or ())
+                return cursor.lastrowid
+        except Exception as e:
+            failed = True
+            raise RuntimeError(f"ERROR: Failed to execute insert: {str(e)}")
+        finally:
+            self._observe("INSERT", start, failed)
+
+    def execute_many(self, query: str, params: Iterable[tuple]) -> int:
+        '''
+            Execute a query once for every parameter tuple with executemany, in one transaction
+                return the number of modified rows
+        '''
+        if not query:
+            raise ValueError("ERROR: Empty query")
+        start = time.perf_counter()
+        failed = False
+        try:
+            with self._scope() as conn:
+                return conn.executemany(query, params).rowcount
+        except Exception as e:
+            failed = True
+            raise RuntimeError(f"ERROR: Failed to execute many: {str(e)}")
+        finally:
+            self._observe(self._operation(query), start, failed)
+
+    def iterate(self, query: str, params: Optional[tuple] = None, batch_size: int = 1000) -> Iterator[sqlite3.Row]:
+        '''
+            Execute a SELECT query and yield the rows, only batch_size rows are held in memory
+        '''
+        try:
+            cursor = self._connect().execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        except Exception as e:
+            raise RuntimeError(f"ERROR: Failed to iterate query: {str(e)}")
+
+    @staticmethod
+    def fts_text(text: Optional[str]) -> Optional[str]:
+        '''
+            The text indexed for full-text search: a zero-width space after every CJK character
+        '''
+        '''
+            备注：
+            unicode61分词器只按空格和标点切分，一整句中文会成为一个词，搜索"名字"找不到"我叫什么名字"
+            因此每个中日韩字符后插入一个零宽空格（unicode61将其视为分隔符），每个字符成为一个词，
+            查询中的"名字"同样被切分为相邻的两个字，作为短语匹配
+            索引通过视图messages_fts_content读取消息，snippet中的零宽空格在查询时去掉
+            fts_text在Database的每个连接上注册，不能用其他工具（如sqlite3命令行）修改messages表
+        '''
+        if not text or text.isascii():
+            return text
+        return CJK_CHARACTER.sub("\\1\u200b", text)
+
+    @classmethod
+    def fts_query(cls, text: str) -> str:
+        '''
+            Convert the search text of a user into an FTS5 query
+                every word is quoted, so the FTS5 operators and special characters in the text are matched literally
+                a trailing * keeps its meaning as a prefix search, e.g. "data*" matches "database"
+                the CJK characters of a word are matched as a phrase, e.g. "名字" matches "我叫什么名字"
+        '''
+        terms = []
+        for word in text.split():
+            prefix = word.endswith("*") and len(word) > 1
+            word = word.rstrip("*")
+            if word:
+                terms.append('"' + cls.fts_text(word).replace('"', '""') + '"' + ("*" if prefix else ""))
+        return " ".join(terms)
+
+    def search_messages(self, user_id: int, text: str, limit: int = 20, offset: int = 0, highlight: tuple[str, str] = ("[", "]")) -> list[sqlite3.Row]:
+        '''
+            Full-text search of the messages of the user, best matches first
+                1. every row has message_id, session_id, message_role, session_title, snippet and rank
+                2. the matched words in the snippet are wrapped in the highlight markers
+                3. limit and offset select the page of the results
+        '''
+        query = self.fts_query(text)
+        if not query:
+            return []
+        '''
+            备注：
+            user_id是FTS5表中被索引的列，user_id的条件写在MATCH表达式中，FTS5直接求两个倒排列表的交集，
+            而不是先找到所有用户的匹配结果再按user_id过滤
+            bm25()中user_id列的权重为0，只按消息内容排序
+        '''
+        match = f'user_id : "{int(user_id)}" AND message_content : ({query})'
+        return self.execute("""
+            SELECT f.rowid AS message_id, m.session_id, m.message_role, s.session_title,
+                replace(snippet(messages_fts, 1, ?, ?, '…', 16), char(8203), '') AS snippet, bm25(messages_fts, 0.0, 1.0) AS rank
+            FROM messages_fts f
+            JOIN messages m ON m.message_id = f.rowid
+            JOIN chat_sessions s ON s.session_id = m.session_id
+            WHERE messages_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        """, (highlight[0], highlight[1], match, limit, offset), fetchall=True)
 
     def execute_batch(self, queries: list[str], params: list[tuple]):
         '''
-            Execute a batch of queries to the database
+            Execute a batch of queries to the database in one transaction
                 dedicated for INSERT, UPDATE, DELETE queries
+                consecutive identical queries are sent together with executemany
         '''
         if not queries:
             return False
         if len(queries) != len(params):
             raise ValueError("ERROR: The number of queries and parameters must be the same")
+        start = time.perf_counter()
+        failed = False
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                for i in range(len(queries)):
-                    cursor.execute(queries[i], params[i])
+            with self._scope() as conn:
+                for query, group in groupby(zip(queries, params), key=lambda pair: pair[0]):
+                    conn.executemany(query, (param for _, param in group))
                 return True
         except Exception as e:
-            raise RuntimeError(f"ERROR: Failed to execute batch queries: {str(e)}")
\ No newline at end of file
+            failed = True
+            raise RuntimeError(f"ERROR: Failed to execute batch queries: {str(e)}")
+        finally:
+            self._observe("BATCH", start, failed)
@@ -1,49 +1,469 @@
 import os
 from sys import float_repr_style
-import openai
 import copy
-from typing import Optional
+import time
+import asyncio
+import hmac
+import hashlib
+import threading
+import weakref
+import json
+import random
+import email.utils
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union
+from Cache import LRUCache, ResponseCache
+import Metrics
 
-class Invoker:
+'''
+    备注：
+    导入openai需要约0.7秒，占进程启动时间的大部分，因此在第一次创建客户端时才导入
+    之后再调用load_openai()只是从sys.modules中取出已导入的模块
+'''
+def load_openai():
+    '''
+        Import the OpenAI SDK on first use
+    '''
+    import openai
+    return openai
+
+class ClientRegistry:
+    '''
+        openai.OpenAI clients shared by all Invokers with the same API key and base url, or openai.AsyncOpenAI clients if asynchronous
+            1. each client keeps its own keep-alive connection pool, HTTP/2 is used if the h2 package is installed
+            2. clients idle for longer than idle_timeout seconds are dropped
+            3. at most max_clients clients are kept, the least recently used one is dropped first
+            4. a dropped client is closed when no Invoker uses it any more, a request or stream in progress is not interrupted
+    '''
+    def __init__(self, max_clients: int = 256, idle_timeout: float = 600.0, asynchronous: bool = False):
+        self.max_clients = max_clients
+        self.asynchronous = asynchronous
+        self.idle_timeout = idle_timeout
+        self.http2 = importlib.util.find_spec("h2") is not None
+        # key -> (client, last_used), the API key itself is never used as a key
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, api_key: str, base_url: str) -> str:
+        return hashlib.sha256(f"{base_url}\n{api_key}".encode("utf-8")).hexdigest()
+
+    def _create(self, api_key: str, base_url: str) -> "openai.OpenAI":
+        openai = load_openai()
+        if self.asynchronous:
+            # an async connection pool cannot be closed from a finalizer, its sockets are closed when it is collected
+            return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=openai.DefaultAsyncHttpxClient(http2=self.http2), max_retries=0)
+        # DefaultHttpxClient keeps the SDK defaults for timeouts and connection limits
+        http_client = openai.DefaultHttpxClient(http2=self.http2)
+        # retries are handled by Invoker, so that they share the backoff and the circuit breaker
+        client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        # the connection pool is closed when the client is garbage collected
+        weakref.finalize(client, http_client.close)
+        return client
+
+    def get(self, api_key: str, base_url: str) -> "openai.OpenAI":
+        '''
+            Get the client of the API key and base url, create it if it does not exist
+        '''
+        key = self._key(api_key, base_url)
+        now = time.monotonic()
+        with self._lock:
+            # the least recently used clients are at the beginning
+            while self._clients:
+                oldest = next(iter(self._clients))
+                if now - self._clients[oldest][1] <= self.idle_timeout:
+                    break
+                self._clients.pop(oldest)
+            if key in self._clients:
+                client = self._clients.pop(key)[0]
+            else:
+                client = self._create(api_key, base_url)
+            self._clients[key] = (client, now)
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+    def pop_all(self) -> list:
+        '''
+            Remove all the clients and return them
+        '''
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            self._clients.clear()
+        return clients
+
+    def close(self):
+        '''
+            Close all the clients, AsyncOpenAI clients are closed with pop_all() and await client.close()
+        '''
+        for client in self.pop_all():
+            client.close()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+class ValidityCache:
+    '''
+        Results of API key validations, keyed by a salted hash of the API key
+            1. valid keys are remembered for valid_ttl seconds, invalid keys for invalid_ttl seconds
+            2. the salt is random per process unless API_KEY_HASH_SALT is set, so the keys cannot be recovered from the cache
+    '''
+    def __init__(self, valid_ttl: float = 3600.0, invalid_ttl: float = 300.0, max_keys: int = 4096):
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        salt = os.getenv("API_KEY_HASH_SALT")
+        self.salt = salt.encode("utf-8") if salt else os.urandom(32)
+        self.cache = LRUCache(max_keys)
+
+    def _key(self, api_key: str, base_url: str) -> str:
+        return hmac.new(self.salt, f"{base_url}\n{api_key}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def get(self, api_key: str, base_url: str) -> Optional[bool]:
+        '''
+            Get the cached validity, None if the key has not been validated recently
+        '''
+        return self.cache.get(self._key(api_key, base_url))
+
+    def put(self, api_key: str, base_url: str, valid: bool):
+        self.cache.put(self._key(api_key, base_url), valid, self.valid_ttl if valid else self.invalid_ttl)
+
+class RateLimiter:
+    '''
+        Token buckets for requests per minute and tokens per minute, None means no limit
+            acquire() reserves the capacity and sleeps while the buckets are in debt
+    '''
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.limits = [requests_per_minute, tokens_per_minute]
+        self.available = [limit if limit else 0.0 for limit in self.limits]
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.updated_at
+            self.updated_at = now
+            wait_seconds = 0.0
+            for i, amount in enumerate([1, tokens]):
+                limit = self.limits[i]
+                if not limit:
+                    continue
+                # refill limit/60 per second, never above one minute of capacity
+                self.available[i] = min(limit, self.available[i] + elapsed * limit / 60)
+                self.available[i] -= amount
+                if self.available[i] < 0:
+                    wait_seconds = max(wait_seconds, -self.available[i] * 60 / limit)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+class InvokeError(RuntimeError):
+    '''
+        Failure of an invocation, the message starts with "ERROR: "
+            1. retryable errors are retried with jittered exponential backoff
+            2. http_status is the status the web application should answer with
+    '''
+    retryable = False
+    http_status = 502
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class InvalidRequestError(InvokeError):
+    http_status = 400
+
+class AuthenticationFailedError(InvokeError):
+    http_status = 401
+
+class RateLimitedError(InvokeError):
+    retryable = True
+    http_status = 429
+
+class UpstreamError(InvokeError):
+    # server errors, timeouts and connection failures
+    retryable = True
+    http_status = 502
+
+class CircuitOpenError(InvokeError):
+    http_status = 503
+
+def parse_retry_after(headers) -> Optional[float]:
+    '''
+        Get the seconds to wait from the retry-after-ms or Retry-After header
+    '''
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        # HTTP date
+        return (email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def to_invoke_error(e: Exception) -> InvokeError:
+    '''
+        Convert an exception of the OpenAI SDK into an InvokeError
+    '''
+    if isinstance(e, InvokeError):
+        return e
+    openai = load_openai()
+    message = f"ERROR: {str(e)}"
+    if isinstance(e, openai.APIStatusError):
+        status = e.status_code
+        retry_after = parse_retry_after(e.response.headers)
+        if status in (401, 403):
+            return AuthenticationFailedError(message, status)
+        if status == 429:
+            return RateLimitedError(message, status, retry_after)
+        if status >= 500 or status in (408, 409):
+            return UpstreamError(message, status, retry_after)
+        return InvalidRequestError(message, status)
+    if isinstance(e, openai.APIConnectionError):
+        return UpstreamError(message)
+    return InvokeError(message)
+
+class InvokeResult(str):
+    '''
+        Response of an invocation, a str so that it can be used as before
+            if the invocation failed, ok is False, error is the InvokeError and the str is "ERROR: ..."
+    '''
+    def __new__(cls, content: str, error: Optional[InvokeError] = None):
+        result = super().__new__(cls, content if error is None else str(error))
+        result.error = error
+        return result
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class CircuitBreaker:
+    '''
+        Circuit breaker of an endpoint
+            1. closed: requests are allowed, failure_threshold consecutive upstream failures open the circuit
+            2. open: requests fail fast for reset_timeout seconds
+            3. half-open: one trial request is allowed, its success closes the circuit and its failure opens it again,
+               a trial without a result for reset_timeout seconds (cancelled or interrupted) is given up and another one is allowed
+    '''
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial or time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout and (not self.trial or now - self.trial_at >= self.reset_timeout):
+                self.trial = True
+                self.trial_at = now
+                return True
+            return False
+
+    def cancel(self):
+        '''
+            Give up the trial request without a result, e.g. when it was cancelled, so that the next request is the trial
+        '''
+        with self._lock:
+            self.trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+class Endpoint:
+    '''
+        An OpenAI-compatible endpoint (base url and model) of a Router
+            latency and error_rate are exponentially weighted moving averages of the requests sent to it
+    '''
+    def __init__(self, base_url: str, model: str, weight: float = 1.0):
+        if weight <= 0:
+            raise ValueError("ERROR: weight must be positive")
+        self.base_url = base_url
+        self.model = model
+        self.weight = weight
+        # seconds until the completion, or until the first token of a stream, None before the first sample
+        self.latency = None
+        self.error_rate = 0.0
+        # start times of the requests in flight
+        self.pending = []
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.base_url!r}, {self.model!r}, {self.weight})"
+
+class Router:
+    '''
+        Latency-aware routing of the requests over a pool of endpoints
+            1. the endpoints are ranked by max(latency, age of the oldest request in flight) / (1 - error_rate) / weight,
+               an endpoint without a latency sample is assumed to be as fast as the median of the others
+            2. with probability explore an endpoint picked by weight goes first, so that the averages of the others stay current
+            3. Invoker tries the endpoints in this order, skips those with an open circuit and fails over on upstream errors
+    '''
+    '''
+        备注：
+        1. 平均延迟只有在请求完成后才会更新，端点变慢时，在第一批慢请求完成前所有请求仍会涌向它
+           因此最早的未完成请求已等待的时间超过平均延迟时，以等待时间作为它的延迟
+        2. error_rate同时统计上游错误和限流（429），认证失败和无效请求与端点无关，不计入
+           除以1 - error_rate近似于失败后重试所需的期望时间
+    '''
+    def __init__(self, endpoints: Iterable[Endpoint], alpha: float = 0.3, explore: float = 0.05):
+        self.endpoints = list(endpoints)
+        if not self.endpoints:
+            raise ValueError("ERROR: Router needs at least one endpoint")
+        self.alpha = alpha
+        self.explore = explore
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec: str, model: str) -> "Router":
+        '''
+            Create a router from "base_url [model] [weight]; base_url [model] [weight]; ..."
+        '''
+        endpoints = []
+        for item in spec.split(";"):
+            fields = item.split()
+            if not fields:
+                continue
+            if len(fields) > 3:
+                raise ValueError(f"ERROR: Invalid endpoint {item.strip()!r}")
+            endpoints.append(Endpoint(fields[0], fields[1] if len(fields) > 1 else model, float(fields[2]) if len(fields) > 2 else 1.0))
+        return cls(endpoints)
+
+    def score(self, endpoint: Endpoint, now: float, prior: float) -> float:
+        '''
+            Get the expected cost of the endpoint, prior is the latency of an endpoint without samples
+        '''
+        latency = prior if endpoint.latency is None else endpoint.latency
+        if endpoint.pending:
+            latency = max(latency, now - endpoint.pending[0])
+        return latency / max(1.0 - endpoint.error_rate, 0.05) / endpoint.weight
+
+    def rank(self) -> list[Endpoint]:
+        '''
+            Get the endpoints in the order they should be tried
+        '''
+        now = time.perf_counter()
+        with self._lock:
+            # the median latency of the pool, any positive value if no endpoint has succeeded yet, so that error_rate still counts
+            latencies = sorted(endpoint.latency for endpoint in self.endpoints if endpoint.latency is not None)
+            prior = latencies[len(latencies) // 2] if latencies else 1.0
+            ranked = sorted(self.endpoints, key=lambda endpoint: self.score(endpoint, now, prior))
+        if len(ranked) > 1 and random.random() < self.explore:
+            chosen = random.choices(ranked, weights=[endpoint.weight for endpoint in ranked])[0]
+            ranked.remove(chosen)
+            ranked.insert(0, chosen)
+        return ranked
+
+    def acquire(self, endpoint: Endpoint, start: float):
+        '''
+            Start a request of the endpoint, start is its time.perf_counter()
+        '''
+        with self._lock:
+            endpoint.pending.append(start)
+
+    def release(self, endpoint: Endpoint, start: float, seconds: Optional[float] = None, failed: bool = False):
+        '''
+            Finish the request of the endpoint started at start, seconds is its latency if it succeeded
+        '''
+        with self._lock:
+            endpoint.pending.remove(start)
+            endpoint.error_rate += self.alpha * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            if seconds is not None:
+                endpoint.latency = seconds if endpoint.latency is None else endpoint.latency + self.alpha * (seconds - endpoint.latency)
+
+# hash(content) -> estimated tokens, keyed by the hash so that the cache does not keep the message bodies alive
+token_estimates = LRUCache(16384)
+
+def estimate_tokens(content: str) -> int:
+    '''
+        Estimate the number of tokens of the content, the result is cached per content
+            about 0.3 token per ASCII character and 0.6 token per other character (e.g. Chinese)
+    '''
+    # the hash of a str is computed once and stored in the str, a collision would only return another estimate
+    key = hash(content)
+    tokens = token_estimates.get(key)
+    if tokens is None:
+        ascii_chars = len(content.encode("ascii", "ignore"))
+        tokens = int(ascii_chars * 0.3 + (len(content) - ascii_chars) * 0.6) + 1
+        token_estimates.put(key, tokens)
+    return tokens
+
+def message_tokens(message: dict) -> int:
+    # every message costs a few extra tokens for the role and separators
+    return estimate_tokens(message["content"] or "") + 4
+
+class BaseInvoker:
+    '''
+        State and logic shared by Invoker and AsyncInvoker: API key, endpoints, role and history, token budget,
+        retries and circuit breakers, everything that does not call the API
+    '''
 
     model = "deepseek-chat"
     base_url = "https://api.deepseek.com"
+    validities = ValidityCache()
+    # validate API keys with the free models list instead of a 1-token completion
+    validate_with_models = os.getenv("DEEPSEEK_VALIDATE_WITH_MODELS", "0") == "1"
+    # maximum estimated tokens of the history sent to the API
+    context_budget = int(os.getenv("DEEPSEEK_CONTEXT_BUDGET", "32000"))
+    # a history over the budget is trimmed down to this fraction of the budget, so it is trimmed again only after several turns
+    context_low_water = float(os.getenv("DEEPSEEK_CONTEXT_LOW_WATER", "0.6"))
+    # fold the messages out of the budget into a summary, costs one extra invocation when the budget is exceeded
+    summarize_history = os.getenv("DEEPSEEK_SUMMARIZE_HISTORY", "0") == "1"
+    # retries of rate limits and upstream failures, the delays are in seconds
+    max_retries = 3
+    backoff_base = 0.5
+    backoff_max = 20.0
+    # circuit breakers per base url
+    breakers = {}
+    breakers_lock = threading.Lock()
+    # pool of endpoints shared by all Invokers, e.g. "https://api.deepseek.com deepseek-chat 2; http://127.0.0.1:8000", None sends every request to base_url
+    router = Router.parse(os.getenv("DEEPSEEK_ENDPOINTS"), model) if os.getenv("DEEPSEEK_ENDPOINTS") else None
 
-    def __init__(self, api_key: Optional[str] = None, role: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, role: Optional[str] = None, base_url: Optional[str] = None, router: Optional[Router] = None):
         # get API key
         self.api_key = api_key if api_key else os.getenv("DEEPSEEK_API_KEY")
         if not self.api_key:
             raise ValueError("ERROR: API key not found")
-        
-        # create client
-        self.client = openai.OpenAI(
-            api_key = self.api_key,
-            base_url = self.base_url
-        )
 
+        # get base url, a local OpenAI-compatible server can be used for testing
+        self.base_url = base_url or os.getenv("DEEPSEEK_BASE_URL") or self.base_url
+
+        # the completions are routed over the endpoints of the router if there is one, otherwise sent to base_url
+        self.router = router or self.router
+        self.endpoint = Endpoint(self.base_url, self.model)
 
         self.role = role
+        self.summary = None
         self.consistency_messages = []
         if self.role:
             self.consistency_messages.append({"role": "system", "content": self.role})
 
-    def test_api_key_validity(self) -> bool:
-        '''
-            Test the API key validity
-        '''
-        try:
-            self.client.chat.completions.create(
-                model = self.model,
-                messages = [{"role": "user", "content": "Hello"}],
-                max_tokens = 1
-            )
-            return True
-        except openai.AuthenticationError:
-            return False
-        except Exception as e:
-            raise RuntimeError(f"ERROR: Failed to test API key validity: {str(e)}")
-
-
     def get_current_role(self) -> str:
         '''
             Get the current role
@@ -55,7 +475,8 @@ class Invoker:
             Resume the given consistency messages
         '''
         self.consistency_messages = consistency_messages
-        if len(self.consistency_messages > 0 and self.consistency_messages[0]["role"] == "system"):
+        self.summary = None
+        if len(self.consistency_messages) > 0 and self.consistency_messages[0]["role"] == "system":
             self.role = self.consistency_messages[0]["content"]
         else:
             self.role = None
@@ -72,6 +493,7 @@ class Invoker:
             Clear the history of consistency messages
         '''
         self.consistency_messages = []
+        self.summary = None
         if self.role:
             self.consistency_messages.append({"role": "system", "content": self.role})
         return True
@@ -110,9 +532,255 @@ class Invoker:
         self.consistency_messages.append({"role": "assistant", "content": "I understand the requirements, and will adjust the output accordingly."})
         return True
 
-    def consistent_invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> str:
+    def count_tokens(self, messages: list[dict]) -> int:
+        '''
+            Estimate the number of tokens of the messages
+        '''
+        return sum(message_tokens(message) for message in messages)
+
+    def trim_messages(self, messages: list[dict], budget: Optional[int] = None, reserve: int = 0) -> tuple[list[dict], list[dict]]:
+        '''
+            Keep the leading system messages and the latest messages within the token budget
+                1. return (kept messages, dropped messages)
+                2. the latest message is always kept, a trimmed history never starts with an assistant reply
+                3. reserve tokens of the budget are left for a message added later, e.g. the summary
+        '''
+        budget = budget if budget is not None else self.context_budget
+        system_count = 0
+        while system_count < len(messages) and messages[system_count]["role"] == "system":
+            system_count += 1
+        used = self.count_tokens(messages[:system_count]) + reserve
+        start = len(messages)
+        for i in range(len(messages) - 1, system_count - 1, -1):
+            tokens = message_tokens(messages[i])
+            if used + tokens > budget and start < len(messages):
+                break
+            used += tokens
+            start = i
+        # nothing is dropped from a history within the budget, even if it starts with a reply kept by an earlier trim
+        while system_count < start < len(messages) - 1 and messages[start]["role"] == "assistant":
+            start += 1
+        return messages[:system_count] + messages[start:], messages[system_count:start]
+
+    def compact_messages(self, messages: list[dict], summary: Optional[str] = None) -> tuple[list[dict], list[dict]]:
+        '''
+            Keep the messages and the summary message within the token budget like trim_messages
+                1. messages do not contain the summary message, the kept messages do not either
+                2. once they exceed the budget they are trimmed down to context_low_water of the budget,
+                   with room for a new summary if summarize_history, so the kept history changes only every few turns
+        '''
+        reserve = message_tokens(self.summary_message(summary)) if summary else 0
+        kept, dropped = self.trim_messages(messages, reserve=reserve)
+        if not dropped:
+            return kept, dropped
+        if self.summarize_history:
+            reserve = max(reserve, message_tokens(self.summary_message("")) + self.summary_tokens())
+        return self.trim_messages(messages, int(self.context_budget * self.context_low_water), reserve)
+
+    def _consistency_history(self) -> list[dict]:
+        '''
+            The consistency messages without the summary message, see _rebuild_consistency_messages
+        '''
+        history = [message for message in self.consistency_messages if message["role"] != "system"]
+        return ([{"role": "system", "content": self.role}] if self.role else []) + history
+
+    def summary_tokens(self) -> int:
+        '''
+            Maximum tokens of a summary: 500, or a quarter of the low-water window if it is smaller,
+            a longer summary would leave too little room for the latest turns and make every turn exceed the budget
+        '''
+        return max(min(500, int(self.context_budget * self.context_low_water / 4)), 1)
+
+    @staticmethod
+    def summary_message(summary: str) -> dict:
+        return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+    def _rebuild_consistency_messages(self, kept: list[dict]):
+        '''
+            Rebuild the consistency messages from the role, the summary and the kept history
+        '''
+        history = [message for message in kept if message["role"] != "system"]
+        self.consistency_messages = []
+        if self.role:
+            self.consistency_messages.append({"role": "system", "content": self.role})
+        if self.summary:
+            self.consistency_messages.append(self.summary_message(self.summary))
+        self.consistency_messages.extend(history)
+
+    @classmethod
+    def get_breaker(cls, base_url: str) -> CircuitBreaker:
+        with cls.breakers_lock:
+            if base_url not in cls.breakers:
+                cls.breakers[base_url] = CircuitBreaker()
+            return cls.breakers[base_url]
+
+    def retry_delay(self, attempt: int, error: InvokeError) -> float:
+        '''
+            Get the seconds to wait before the next attempt
+                the Retry-After of the server takes precedence over the jittered exponential backoff
+        '''
+        if error.retry_after is not None:
+            return min(self.backoff_max, error.retry_after if error.retry_after > 0 else 0.0)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _record(self, error: Optional[InvokeError], endpoint: Optional[Endpoint] = None):
+        endpoint = endpoint or self.endpoint
+        Metrics.upstream_endpoint_requests.inc(endpoint=endpoint.base_url, model=endpoint.model, outcome="ok" if error is None else "error")
+        if error is not None:
+            Metrics.upstream_errors.inc(model=endpoint.model, type=type(error).__name__)
+        # only upstream failures count against the endpoint, rate limits and invalid requests do not
+        breaker = self.get_breaker(endpoint.base_url)
+        if isinstance(error, UpstreamError):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def _release(self, endpoint: Endpoint, start: float, seconds: Optional[float] = None, error: Optional[InvokeError] = None):
+        if self.router is not None:
+            self.router.release(endpoint, start, seconds, isinstance(error, (UpstreamError, RateLimitedError)))
+
+    def _abandon(self, endpoint: Endpoint, start: float):
+        '''
+            Give up a request interrupted without a result (cancelled, KeyboardInterrupt, worker timeout)
+        '''
+        self.get_breaker(endpoint.base_url).cancel()
+        self._release(endpoint, start)
+
+    def _unavailable(self) -> CircuitOpenError:
+        Metrics.upstream_errors.inc(model=self.model, type=CircuitOpenError.__name__)
+        target = self.base_url if self.router is None else "every endpoint"
+        return CircuitOpenError(f"ERROR: {target} is unavailable, please try again later")
+
+class Invoker(BaseInvoker):
+
+    clients = ClientRegistry()
+
+    def __init__(self, api_key: Optional[str] = None, role: Optional[str] = None, base_url: Optional[str] = None, response_cache: Optional[ResponseCache] = None, router: Optional[Router] = None):
+        super().__init__(api_key, role, base_url, router)
+
+        # reuse the shared client, so repeated turns skip the connection setup
+        self.client = self.clients.get(self.api_key, self.base_url)
+
+        # opt-in cache of the invoke() responses, can be shared between Invokers
+        self.response_cache = response_cache
+
+    def test_api_key_validity(self, use_models: Optional[bool] = None) -> bool:
+        '''
+            Test the API key validity
+                1. the cached result is returned if the key has been validated recently
+                2. use_models validates with the models list, which does not consume tokens
+        '''
+        valid = self.validities.get(self.api_key, self.base_url)
+        if valid is not None:
+            return valid
+        use_models = self.validate_with_models if use_models is None else use_models
+        try:
+            if use_models:
+                self.client.models.list()
+            else:
+                # retried like the other completions, so a transient upstream error does not fail the login
+                self._send([{"role": "user", "content": "Hello"}], 1.0, 1)
+            valid = True
+        except (load_openai().AuthenticationError, AuthenticationFailedError):
+            valid = False
+        except Exception as e:
+            # network errors and outages are not cached
+            raise RuntimeError(f"ERROR: Failed to test API key validity: {str(e)}")
+        self.validities.put(self.api_key, self.base_url, valid)
+        return valid
+
+    def summarize(self, messages: list[dict], summary: Optional[str] = None, max: Optional[int] = None) -> InvokeResult:
+        '''
+            Fold the messages into the previous summary
+                at most summary_tokens() tokens by default
+        '''
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if summary:
+            transcript = f"Previous summary: {summary}\n{transcript}"
+        return self.message_invoke([
+            {"role": "system", "content": "Summarize the following conversation in a short paragraph. Keep the facts, names, decisions and open questions."},
+            {"role": "user", "content": transcript}
+        ], temp=0.3, max=max or self.summary_tokens())
+
+    def _fold_consistency_messages(self):
+        '''
+            Keep the consistency messages within the token budget, optionally fold the dropped ones into the summary
+        '''
+        kept, dropped = self.compact_messages(self._consistency_history(), self.summary)
+        if not dropped:
+            return
+        if self.summarize_history:
+            summary = self.summarize(dropped, self.summary)
+            if summary.ok:
+                self.summary = summary
+        self._rebuild_consistency_messages(kept)
+
+    def _send(self, messages: list[dict], temp: float, max: int, stream: bool = False) -> tuple[Endpoint, object, float]:
+        '''
+            Send the request to the API with retries, failover and the circuit breakers of the endpoints
+                1. the endpoints are tried in the order of the router, an endpoint with an open circuit is skipped
+                2. a retryable failure fails over to the next endpoint at once,
+                   after every endpoint failed the backoff is waited and they are tried again, at most max_retries times
+                return the endpoint, the completion (or the stream) and the time it was sent, raise InvokeError on failure
+                the stream is neither recorded nor released from the router, stream_invoke does both at its end
+        '''
+        attempt = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                error = None
+                for endpoint in self.router.rank() if self.router is not None else [self.endpoint]:
+                    if not self.get_breaker(endpoint.base_url).allow():
+                        continue
+                    client = self.client if self.router is None else self.clients.get(self.api_key, endpoint.base_url)
+                    sent = time.perf_counter()
+                    if self.router is not None:
+                        self.router.acquire(endpoint, sent)
+                    try:
+                        with Metrics.upstream_request_seconds.time(model=endpoint.model, stream=str(stream).lower()):
+                            response = client.chat.completions.create(
+                                model = endpoint.model,
+                                messages = messages,
+                                temperature = temp,
+                                max_tokens = max,
+                                stream = stream,
+                                # the usage of a streamed completion is sent in an extra chunk at the end
+                                stream_options = {"include_usage": True} if stream else load_openai().NOT_GIVEN
+                            )
+                    except Exception as e:
+                        error, cause = to_invoke_error(e), e
+                        self._record(error, endpoint)
+                        self._release(endpoint, sent, error=error)
+                        if not error.retryable:
+                            raise error from e
+                        continue
+                    except BaseException:
+                        self._abandon(endpoint, sent)
+                        raise
+                    # the outcome of a stream is only known at its end, stream_invoke records it then
+                    if not stream:
+                        self._record(None, endpoint)
+                        self._release(endpoint, sent, time.perf_counter() - sent)
+                    return endpoint, response, sent
+                if error is None:
+                    raise self._unavailable()
+                if attempt >= self.max_retries:
+                    raise error from cause
+                time.sleep(self.retry_delay(attempt, error))
+                attempt += 1
+        finally:
+            # retries and backoff included, for streams only until the response headers
+            Metrics.add_timing("upstream", time.perf_counter() - start)
+
+    def _complete(self, messages: list[dict], temp: float, max: int) -> str:
+        endpoint, response, _ = self._send(messages, temp, max)
+        Metrics.record_usage(endpoint.model, response.usage)
+        return response.choices[0].message.content or ""
+
+    def consistent_invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
         '''
             Invoke the API with the consistency messages
+                the consistency messages are kept within the token budget
         '''
         '''
             备注：
@@ -125,66 +793,108 @@ class Invoker:
         '''
         # check if prompt is empty
         if not prompt.strip():
-            return "ERROR: Empty prompt"
+            return InvokeResult("", InvalidRequestError("ERROR: Empty prompt"))
 
         # check if temp is between 0 and 2
         if temp < 0 or temp > 2:
-            return "ERROR: Temperature must be between 0 and 2"
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
 
         # add the prompt to the consistency messages
         self.consistency_messages.append({"role": "user", "content": prompt})
 
         # invoke API
         try:
-            response = self.client.chat.completions.create(
-                model = self.model,
-                messages = self.consistency_messages,
-                temperature = temp,
-                max_tokens = max
-            )
-            result = response.choices[0].message.content
-            self.consistency_messages.append({"role": "assistant", "content": result})
-            return result
+            result = self._complete(self.consistency_messages, temp, max)
         except Exception as e:
             self.consistency_messages.pop()
-            return f"ERROR: {str(e)}"
+            return InvokeResult("", to_invoke_error(e))
+        self.consistency_messages.append({"role": "assistant", "content": result})
+        self._fold_consistency_messages()
+        return InvokeResult(result)
 
-    def message_invoke(self, messages: list[dict], temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> str:
+    def message_invoke(self, messages: list[dict], temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
         '''
             Invoke the API with the given messages
         '''
         # check if messages is empty
         if not messages:
-            return "ERROR: Empty messages"
+            return InvokeResult("", InvalidRequestError("ERROR: Empty messages"))
         
         # check if temp is between 0 and 2
         if temp < 0 or temp > 2:
-            return "ERROR: Temperature must be between 0 and 2"
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
+
+        # keep the history within the token budget
+        messages, _ = self.trim_messages(messages)
 
         # invoke API
         try:
-            response = self.client.chat.completions.create(
-                model = self.model,
-                messages = messages,
-                temperature = temp,
-                max_tokens = max
-            )
-            return response.choices[0].message.content
+            return InvokeResult(self._complete(messages, temp, max))
         except Exception as e:
-            return f"ERROR: {str(e)}"
-        
+            return InvokeResult("", to_invoke_error(e))
 
-    def invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> str:
+    def stream_invoke(self, messages: list[dict], temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> Iterator[str]:
+        '''
+            Invoke the API with the given messages in streaming mode
+                yield the content deltas as soon as they arrive, raise InvokeError on failure
+                the request is retried only before the first delta
+        '''
+        # check if messages is empty
+        if not messages:
+            raise ValueError("ERROR: Empty messages")
+
+        # check if temp is between 0 and 2
+        if temp < 0 or temp > 2:
+            raise ValueError("ERROR: Temperature must be between 0 and 2")
+
+        # keep the history within the token budget
+        messages, _ = self.trim_messages(messages)
+
+        # invoke API
+        endpoint, stream, sent = self._send(messages, temp, max, stream=True)
+        '''
+            备注：
+            stream=True时返回的是一个可迭代的Stream对象，每个chunk中的delta.content为新生成的片段
+            最后一个chunk的delta.content可能为None，需要跳过
+            include_usage时最后还有一个choices为空、只包含usage的chunk
+        '''
+        # the time to the first token is the latency of the endpoint for the router
+        first_token = None
+        error = None
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    Metrics.record_usage(endpoint.model, chunk.usage)
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token is None:
+                        first_token = time.perf_counter() - sent
+                        Metrics.upstream_first_token_seconds.observe(first_token, model=endpoint.model)
+                    yield delta
+        except Exception as e:
+            error = to_invoke_error(e)
+            self._record(error, endpoint)
+            raise error from e
+        finally:
+            stream.close()
+            # one outcome per attempt: an error raised mid-stream replaces the success of the headers
+            if error is None:
+                self._record(None, endpoint)
+            self._release(endpoint, sent, first_token, error)
+
+    def invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
         '''
             Invoke the API independently
+                the response is cached if the Invoker has a response cache and the cache accepts the temperature
         '''
         # checl if prompt is empty
         if not prompt.strip():
-            return "ERROR: Empty prompt"
+            return InvokeResult("", InvalidRequestError("ERROR: Empty prompt"))
 
         # check if temp is between 0 and 2
         if temp < 0 or temp > 2:
-            return "ERROR: Temperature must be between 0 and 2"
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
 
         invoke_messages = []
         if self.role:
@@ -193,17 +903,367 @@ class Invoker:
 
         # invoke API
         try:
-            response = self.client.chat.completions.create(
-                model = self.model,
-                messages = invoke_messages,
-                temperature = temp,
-                max_tokens = max
-            )
-            return response.choices[0].message.content
+            if self.response_cache is None or not self.response_cache.cacheable(temp):
+                return InvokeResult(self._complete(invoke_messages, temp, max))
+            key = self.response_cache.key(self.base_url, self.model, invoke_messages, temp, max)
+            return InvokeResult(self.response_cache.get_or_create(key, lambda: self._complete(invoke_messages, temp, max)))
         except Exception as e:
-            return f"ERROR: {str(e)}"
+            return InvokeResult("", to_invoke_error(e))
 
+    def invoke_many(self, items: Iterable[Union[str, list[dict]]], temp: Optional[float] = 1.0, max: Optional[int] = 1000, concurrency: int = 8, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None, ordered: bool = True, checkpoint: Optional[str] = None) -> Iterator[tuple[int, InvokeResult]]:
+        '''
+            Invoke the API for every item with bounded parallelism, yield (index, response)
+                1. a str item is sent with invoke(), a list of messages is sent with message_invoke()
+                2. at most concurrency requests are in flight, requests_per_minute and tokens_per_minute limit the rate
+                3. ordered yields the responses in the order of the items, otherwise as soon as they complete
+                4. successful responses are appended to the checkpoint file (JSONL),
+                   a resumed run yields them again without invoking the API
+        '''
+        if concurrency <= 0:
+            raise ValueError("ERROR: concurrency must be positive")
+        max_tokens = max
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
 
+        # load the finished items of a previous run
+        finished = {}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be incomplete if the previous run crashed
+                        continue
+                    finished[record["index"]] = InvokeResult(record["response"])
+        checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+        if checkpoint_file and checkpoint_file.tell() > 0:
+            # start a new line after an incomplete last line
+            checkpoint_file.write("\n")
+        checkpoint_lock = threading.Lock()
+
+        def run(index: int, item: Union[str, list[dict]]) -> tuple[int, InvokeResult]:
+            # reserve the prompt tokens plus the maximum completion tokens
+            if isinstance(item, str):
+                limiter.acquire(estimate_tokens(item) + max_tokens)
+                response = self.invoke(item, temp, max_tokens)
+            else:
+                limiter.acquire(self.count_tokens(item) + max_tokens)
+                response = self.message_invoke(item, temp, max_tokens)
+            if checkpoint_file and response.ok:
+                with checkpoint_lock:
+                    checkpoint_file.write(json.dumps({"index": index, "response": response}, ensure_ascii=False) + "\n")
+                    checkpoint_file.flush()
+            return index, response
+
+        '''
+            备注：
+            items按需读取，已提交但未返回的任务与已完成但未输出的结果总数不超过2 * concurrency，因此内存占用有上限
+            ordered模式下，结果先放入ready中，按照下标顺序依次输出
+        '''
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = set()
+        ready = {}
+        next_index = 0
+        items = enumerate(items)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) + len(ready) < 2 * concurrency:
+                    try:
+                        index, item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if index in finished:
+                        ready[index] = finished.pop(index)
+                    else:
+                        pending.add(executor.submit(run, index, item))
+                if ordered:
+                    while next_index in ready:
+                        yield next_index, ready.pop(next_index)
+                        next_index += 1
+                else:
+                    for index in list(ready):
+                        yield index, ready.pop(index)
+                if not pending:
+                    if exhausted:
+                        break
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, response = future.result()
+                    ready[index] = response
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            if checkpoint_file:
+                checkpoint_file.close()
+
+
+class AsyncInvoker(BaseInvoker):
+
+    '''
+        Asynchronous counterpart of Invoker backed by openai.AsyncOpenAI
+            1. invoke, message_invoke, consistent_invoke and summarize are coroutines, stream_invoke is an async generator
+            2. max_concurrency limits the number of in-flight upstream requests of this instance,
+               semaphore shares one limit between the AsyncInvokers of an event loop
+            3. the clients are shared per event loop, API key and base url
+    '''
+    '''
+        备注：
+        AsyncOpenAI内部的连接池和asyncio.Semaphore都绑定在首次使用它们的事件循环上
+        因此客户端按事件循环分别保存，事件循环被回收时它的客户端也随之释放（WeakKeyDictionary）
+    '''
+    # event loop -> ClientRegistry of the AsyncOpenAI clients used in it
+    loop_clients = weakref.WeakKeyDictionary()
+    loop_clients_lock = threading.Lock()
+
+    def __init__(self, api_key: Optional[str] = None, role: Optional[str] = None, base_url: Optional[str] = None, max_concurrency: int = 64, router: Optional[Router] = None, semaphore: Optional[asyncio.Semaphore] = None):
+        super().__init__(api_key, role, base_url, router)
+        if semaphore is None:
+            if max_concurrency <= 0:
+                raise ValueError("ERROR: max_concurrency must be positive")
+            semaphore = asyncio.Semaphore(max_concurrency)
+        self.semaphore = semaphore
+
+    def _client(self, base_url: str) -> "openai.AsyncOpenAI":
+        '''
+            Get the client of the API key and base url in the current event loop
+        '''
+        loop = asyncio.get_running_loop()
+        with self.loop_clients_lock:
+            registry = self.loop_clients.get(loop)
+            if registry is None:
+                registry = self.loop_clients[loop] = ClientRegistry(asynchronous=True)
+        return registry.get(self.api_key, base_url)
+
+    async def _send(self, messages: list[dict], temp: float, max: int, stream: bool = False) -> tuple[Endpoint, object, float]:
+        '''
+            Send the request to the API with retries, failover and the circuit breakers of the endpoints like Invoker._send
+                wait if max_concurrency requests are in flight, the semaphore is released during the backoff
+                a stream is sent while stream_invoke holds the semaphore, it is neither recorded nor released from the router
+        '''
+        attempt = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                error = None
+                for endpoint in self.router.rank() if self.router is not None else [self.endpoint]:
+                    if not self.get_breaker(endpoint.base_url).allow():
+                        continue
+                    # the wait for the semaphore counts as time in flight, the latency starts when the request is sent
+                    sent = time.perf_counter()
+                    if self.router is not None:
+                        self.router.acquire(endpoint, sent)
+                    try:
+                        async with nullcontext() if stream else self.semaphore:
+                            started = time.perf_counter()
+                            with Metrics.upstream_request_seconds.time(model=endpoint.model, stream=str(stream).lower()):
+                                response = await self._client(endpoint.base_url).chat.completions.create(
+                                    model = endpoint.model,
+                                    messages = messages,
+                                    temperature = temp,
+                                    max_tokens = max,
+                                    stream = stream,
+                                    stream_options = {"include_usage": True} if stream else load_openai().NOT_GIVEN
+                                )
+                    except Exception as e:
+                        error, cause = to_invoke_error(e), e
+                        self._record(error, endpoint)
+                        self._release(endpoint, sent, error=error)
+                        if not error.retryable:
+                            raise error from e
+                        continue
+                    except BaseException:
+                        # asyncio.CancelledError, e.g. the client disconnected or a timeout expired
+                        self._abandon(endpoint, sent)
+                        raise
+                    if not stream:
+                        self._record(None, endpoint)
+                        self._release(endpoint, sent, time.perf_counter() - started)
+                    return endpoint, response, sent
+                if error is None:
+                    raise self._unavailable()
+                if attempt >= self.max_retries:
+                    raise error from cause
+                await asyncio.sleep(self.retry_delay(attempt, error))
+                attempt += 1
+        finally:
+            Metrics.add_timing("upstream", time.perf_counter() - start)
+
+    async def _complete(self, messages: list[dict], temp: float, max: int) -> str:
+        endpoint, response, _ = await self._send(messages, temp, max)
+        Metrics.record_usage(endpoint.model, response.usage)
+        return response.choices[0].message.content or ""
+
+    async def test_api_key_validity(self, use_models: Optional[bool] = None) -> bool:
+        '''
+            Test the API key validity, the results are shared with Invoker
+        '''
+        valid = self.validities.get(self.api_key, self.base_url)
+        if valid is not None:
+            return valid
+        use_models = self.validate_with_models if use_models is None else use_models
+        try:
+            if use_models:
+                async with self.semaphore:
+                    await self._client(self.base_url).models.list()
+            else:
+                await self._send([{"role": "user", "content": "Hello"}], 1.0, 1)
+            valid = True
+        except (load_openai().AuthenticationError, AuthenticationFailedError):
+            valid = False
+        except Exception as e:
+            raise RuntimeError(f"ERROR: Failed to test API key validity: {str(e)}")
+        self.validities.put(self.api_key, self.base_url, valid)
+        return valid
+
+    async def summarize(self, messages: list[dict], summary: Optional[str] = None, max: Optional[int] = None) -> InvokeResult:
+        '''
+            Fold the messages into the previous summary
+                at most summary_tokens() tokens by default
+        '''
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if summary:
+            transcript = f"Previous summary: {summary}\n{transcript}"
+        return await self.message_invoke([
+            {"role": "system", "content": "Summarize the following conversation in a short paragraph. Keep the facts, names, decisions and open questions."},
+            {"role": "user", "content": transcript}
+        ], temp=0.3, max=max or self.summary_tokens())
+
+    async def _fold_consistency_messages(self):
+        '''
+            Keep the consistency messages within the token budget, optionally fold the dropped ones into the summary
+        '''
+        kept, dropped = self.compact_messages(self._consistency_history(), self.summary)
+        if not dropped:
+            return
+        if self.summarize_history:
+            summary = await self.summarize(dropped, self.summary)
+            if summary.ok:
+                self.summary = summary
+        self._rebuild_consistency_messages(kept)
+
+    async def consistent_invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
+        '''
+            Invoke the API with the consistency messages
+        '''
+        # check if prompt is empty
+        if not prompt.strip():
+            return InvokeResult("", InvalidRequestError("ERROR: Empty prompt"))
+
+        # check if temp is between 0 and 2
+        if temp < 0 or temp > 2:
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
+
+        # add the prompt to the consistency messages
+        self.consistency_messages.append({"role": "user", "content": prompt})
+
+        # invoke API
+        try:
+            result = await self._complete(self.consistency_messages, temp, max)
+        except Exception as e:
+            self.consistency_messages.pop()
+            return InvokeResult("", to_invoke_error(e))
+        self.consistency_messages.append({"role": "assistant", "content": result})
+        await self._fold_consistency_messages()
+        return InvokeResult(result)
+
+    async def message_invoke(self, messages: list[dict], temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
+        '''
+            Invoke the API with the given messages
+        '''
+        # check if messages is empty
+        if not messages:
+            return InvokeResult("", InvalidRequestError("ERROR: Empty messages"))
+
+        # check if temp is between 0 and 2
+        if temp < 0 or temp > 2:
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
+
+        # keep the history within the token budget
+        messages, _ = self.trim_messages(messages)
+
+        # invoke API
+        try:
+            return InvokeResult(await self._complete(messages, temp, max))
+        except Exception as e:
+            return InvokeResult("", to_invoke_error(e))
+
+    async def stream_invoke(self, messages: list[dict], temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> AsyncIterator[str]:
+        '''
+            Invoke the API with the given messages in streaming mode, an async generator
+                yield the content deltas as soon as they arrive, raise InvokeError on failure
+                the stream holds one of the max_concurrency slots until it ends, the backoff of its retries included
+        '''
+        # check if messages is empty
+        if not messages:
+            raise ValueError("ERROR: Empty messages")
+
+        # check if temp is between 0 and 2
+        if temp < 0 or temp > 2:
+            raise ValueError("ERROR: Temperature must be between 0 and 2")
+
+        # keep the history within the token budget
+        messages, _ = self.trim_messages(messages)
+
+        # invoke API
+        async with self.semaphore:
+            endpoint, stream, sent = await self._send(messages, temp, max, stream=True)
+            first_token = None
+            error = None
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        Metrics.record_usage(endpoint.model, chunk.usage)
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first_token is None:
+                            first_token = time.perf_counter() - sent
+                            Metrics.upstream_first_token_seconds.observe(first_token, model=endpoint.model)
+                        yield delta
+            except Exception as e:
+                error = to_invoke_error(e)
+                self._record(error, endpoint)
+                raise error from e
+            finally:
+                await stream.close()
+                if error is None:
+                    self._record(None, endpoint)
+                self._release(endpoint, sent, first_token, error)
+
+    async def invoke(self, prompt: str, temp: Optional[float] = 1.0, max: Optional[int] = 1000) -> InvokeResult:
+        '''
+            Invoke the API independently
+        '''
+        # check if prompt is empty
+        if not prompt.strip():
+            return InvokeResult("", InvalidRequestError("ERROR: Empty prompt"))
+
+        # check if temp is between 0 and 2
+        if temp < 0 or temp > 2:
+            return InvokeResult("", InvalidRequestError("ERROR: Temperature must be between 0 and 2"))
+
+        invoke_messages = []
+        if self.role:
+            invoke_messages.append({"role": "system", "content": self.role})
+        invoke_messages.append({"role": "user", "content": prompt})
+
+        # invoke API
+        try:
+            return InvokeResult(await self._complete(invoke_messages, temp, max))
+        except Exception as e:
+            return InvokeResult("", to_invoke_error(e))
+
+    async def close(self):
+        '''
+            Close the clients of the current event loop, e.g. before the event loop is closed
+        '''
+        with self.loop_clients_lock:
+            registry = self.loop_clients.pop(asyncio.get_running_loop(), None)
+        if registry is not None:
+            for client in registry.pop_all():
+                await client.close()
 
 if __name__ == "__main__":
     # invoker = Invoker("YOUR_API_KEY", "你是一个乐于助人的助手，请根据用户的问题，给出详细的回答")
@@ -0,0 +1,219 @@
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+'''
+    备注：
+    进程内的监控指标，以Prometheus文本格式在/metrics导出
+    1. Counter只增不减，Histogram按桶统计观测值的分布（同时记录总和与次数）
+    2. 每个指标可以有若干标签，标签值的组合应当是有限的（例如路由规则而不是URL）
+    3. 多进程部署时每个进程有自己的指标，由Prometheus按实例分别抓取
+'''
+
+# seconds, from a cached database read to a long completion
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Counter:
+    '''
+        Monotonically increasing value per combination of label values
+    '''
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    '''
+        Distribution of observed values per combination of label values
+            every combination keeps a count per bucket, the sum and the number of observations
+    '''
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [counts per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        # the counts are not cumulative here, they are accumulated in render()
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+            Observe the seconds spent in the with block, also if it raises
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            return sum(entry[0]) if entry else 0
+
+    def total(self) -> int:
+        '''
+            Get the number of observations of all the label values
+        '''
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Registry:
+    '''
+        The metrics exported together in the Prometheus text format
+    '''
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"ERROR: Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_request_seconds = registry.histogram("http_request_duration_seconds", "Latency of the HTTP requests by route", ("method", "route", "status"))
+http_exceptions = registry.counter("http_exceptions_total", "Unhandled exceptions of the HTTP requests by type", ("route", "type"))
+stage_seconds = registry.histogram("request_stage_duration_seconds", "Time spent assembling the prompt and rendering the templates of a request", ("stage",))
+db_query_seconds = registry.histogram("db_query_duration_seconds", "Latency of the database statements by kind", ("operation",))
+db_errors = registry.counter("db_errors_total", "Failed database statements by kind", ("operation",))
+upstream_request_seconds = registry.histogram("upstream_request_duration_seconds", "Latency of the API requests until the completion (or the stream) is returned", ("model", "stream"))
+upstream_first_token_seconds = registry.histogram("upstream_time_to_first_token_seconds", "Time from the streaming API request to the first content delta", ("model",))
+upstream_tokens = registry.histogram("upstream_tokens", "Prompt and completion tokens reported in the usage of the API responses", ("model", "kind"), TOKEN_BUCKETS)
+upstream_endpoint_requests = registry.counter("upstream_endpoint_requests_total", "API attempts by endpoint, the failovers of the router included", ("endpoint", "model", "outcome"))
+upstream_errors = registry.counter("upstream_errors_total", "Failed API attempts by error type, retried attempts included", ("model", "type"))
+
+'''
+    备注：
+    当前请求各阶段的耗时保存在ContextVar中，每个请求（线程或协程）互不影响
+    start_timings()在请求开始时调用，之后timed()和add_timing()累加到同名阶段，用于生成Server-Timing响应头
+'''
+_timings = contextvars.ContextVar("timings", default=None)
+
+def start_timings() -> dict:
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+def get_timings() -> Optional[dict]:
+    return _timings.get()
+
+def add_timing(stage: str, seconds: float):
+    '''
+        Add the seconds to the stage of the current request, if a request is being timed
+    '''
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(stage: str):
+    '''
+        Observe the seconds spent in the with block as a stage of the current request
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=stage)
+        add_timing(stage, seconds)
+
+def server_timing(timings: dict, total: Optional[float] = None) -> str:
+    '''
+        Format the timings as a Server-Timing header, in milliseconds
+    '''
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+def record_usage(model: str, usage):
+    '''
+        Observe the token counts of the usage of an API response, usage may be None
+    '''
+    if usage is None:
+        return
+    if getattr(usage, "prompt_tokens", None) is not None:
+        upstream_tokens.observe(usage.prompt_tokens, model=model, kind="prompt")
+    if getattr(usage, "completion_tokens", None) is not None:
+        upstream_tokens.observe(usage.completion_tokens, model=model, kind="completion")
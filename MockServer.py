@@ -0,0 +1,173 @@
+import json
+import time
+import random
+import argparse
+from typing import Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+    备注：
+    本地的OpenAI兼容服务器，用于在没有DeepSeek API key的情况下测试Invoker和App
+    使用方法：
+    1. python MockServer.py --port 8000
+    2. export DEEPSEEK_BASE_URL="http://127.0.0.1:8000"
+    回复内容为最后一条用户消息的回显，流式模式下按单词逐个返回，超过max_tokens个单词的部分被截断
+    以"invalid"开头的API key会返回401，用于测试登录失败的情况
+'''
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    # keep-alive for non-streaming responses, streaming responses close the connection
+    protocol_version = "HTTP/1.1"
+
+    # seconds to wait before the first token / between two streamed tokens
+    latency = 0.0
+    token_latency = 0.0
+    # up to jitter seconds are added to the latency at random, so that the percentiles differ
+    jitter = 0.0
+    # probability of answering a completion with error_status, 429 responses carry a Retry-After header
+    error_rate = 0.0
+    error_status = 503
+    # the headers and the body are written separately, with Nagle's algorithm every response waited ~40ms for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _reply(self, messages: list[dict]) -> str:
+        '''
+            Build the reply for the given messages
+        '''
+        for message in reversed(messages):
+            if message.get("role") == "user":
+                return f"Echo: {message.get('content', '')}"
+        return "Echo:"
+
+    def _usage(self, messages: list[dict], reply: str) -> dict:
+        '''
+            Count the tokens as words, enough to exercise the token metrics
+        '''
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in messages)
+        completion_tokens = len(reply.split())
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def _chunk(self, model: str, content: Optional[str] = None, finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content} if content is not None else {}, "finish_reason": finish_reason}]
+        }
+        if usage is not None:
+            # the usage chunk of stream_options.include_usage has no choices
+            chunk["choices"] = []
+            chunk["usage"] = usage
+        return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+    def _authorized(self) -> bool:
+        '''
+            API keys starting with "invalid" are rejected with 401
+        '''
+        api_key = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        if api_key.startswith("invalid"):
+            self._send_json(401, {"error": {"message": "Authentication Fails", "type": "authentication_error"}})
+            return False
+        return True
+
+    def _send_error_status(self):
+        data = json.dumps({"error": {"message": f"Mock error {self.error_status}"}}).encode("utf-8")
+        self.send_response(self.error_status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.error_status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if not self.path.endswith("/models"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        if not self._authorized():
+            return
+        self._send_json(200, {"object": "list", "data": [{"id": "deepseek-chat", "object": "model", "owned_by": "deepseek"}]})
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        if not self._authorized():
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if random.random() < self.error_rate:
+            self._send_error_status()
+            return
+        model = body.get("model", "deepseek-chat")
+        reply = self._reply(body.get("messages", []))
+        # like the real API the reply stops at max_tokens, a token is a word here
+        words = reply.split(" ")
+        finish_reason = "stop"
+        if body.get("max_tokens") and len(words) > body["max_tokens"]:
+            reply = " ".join(words[:body["max_tokens"]])
+            finish_reason = "length"
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            words = reply.split(" ")
+            for i, word in enumerate(words):
+                self.wfile.write(self._chunk(model, word if i == 0 else " " + word))
+                self.wfile.flush()
+                time.sleep(self.token_latency)
+            self.wfile.write(self._chunk(model, finish_reason=finish_reason))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self.wfile.write(self._chunk(model, usage=self._usage(body.get("messages", []), reply)))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            return
+
+        self._send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": finish_reason}],
+            "usage": self._usage(body.get("messages", []), reply)
+        })
+
+def create_server(host: str = "127.0.0.1", port: int = 8000, latency: float = 0.0, token_latency: float = 0.0, error_rate: float = 0.0, error_status: int = 503, jitter: float = 0.0) -> ThreadingHTTPServer:
+    '''
+        Create the mock server, call serve_forever() to start it
+            port 0 picks a free port, see server.server_address
+    '''
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"latency": latency, "token_latency": token_latency, "error_rate": error_rate, "error_status": error_status, "jitter": jitter})
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds are added to the latency at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of an error response")
+    parser.add_argument("--error-status", type=int, default=503, help="status code of the error responses")
+    args = parser.parse_args()
+    server = create_server(args.host, args.port, args.latency, args.token_latency, args.error_rate, args.error_status, args.jitter)
+    print(f"Mock server running on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -10,6 +10,10 @@ CREATE TABLE chat_sessions (
     session_title TEXT NOT NULL,
     temp REAL NOT NULL CHECK (temp >= 0 AND temp <= 2),
     session_created_at TEXT NOT NULL,
+    session_summary TEXT,
+    context_start_id INTEGER NOT NULL DEFAULT 0,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_activity_at TEXT,
     FOREIGN KEY (user_id) REFERENCES users (user_id)
 );
 
@@ -24,4 +28,63 @@ CREATE TABLE messages (
 );
 
 CREATE INDEX idx_messages_user_session_id ON messages (user_id, session_id, message_id);
-CREATE INDEX idx_chat_sessions_user_created ON chat_sessions (user_id, session_created_at DESC);
\ No newline at end of file
+CREATE INDEX idx_chat_sessions_user_created ON chat_sessions (user_id, session_created_at DESC, session_id DESC);
+
+-- message count and last activity of the chat sessions, system messages are not counted
+CREATE TRIGGER trg_messages_insert_summary AFTER INSERT ON messages WHEN NEW.message_role != 'system'
+BEGIN
+    UPDATE chat_sessions SET message_count = message_count + 1, last_activity_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime') WHERE session_id = NEW.session_id;
+END;
+
+CREATE TRIGGER trg_messages_delete_summary AFTER DELETE ON messages WHEN OLD.message_role != 'system'
+BEGIN
+    UPDATE chat_sessions SET message_count = message_count - 1 WHERE session_id = OLD.session_id;
+END;
+
+CREATE TABLE response_cache (
+    cache_key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE INDEX idx_response_cache_created ON response_cache (created_at);
+
+-- full-text index of the user and assistant messages, user_id is indexed so that MATCH can scope the search to one user
+-- the CJK characters are separated by fts_text() (registered by Database), so that every character is a token
+CREATE VIEW messages_fts_content AS SELECT message_id, user_id, fts_text(message_content) AS message_content FROM messages WHERE message_role != 'system';
+
+CREATE VIRTUAL TABLE messages_fts USING fts5 (
+    user_id,
+    message_content,
+    content = 'messages_fts_content',
+    content_rowid = 'message_id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages WHEN NEW.message_role != 'system'
+BEGIN
+    INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, fts_text(NEW.message_content));
+END;
+
+CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages WHEN OLD.message_role != 'system'
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, fts_text(OLD.message_content));
+END;
+
+CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF user_id, message_content ON messages WHEN NEW.message_role != 'system'
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, user_id, message_content) VALUES ('delete', OLD.message_id, OLD.user_id, fts_text(OLD.message_content));
+    INSERT INTO messages_fts (rowid, user_id, message_content) VALUES (NEW.message_id, NEW.user_id, fts_text(NEW.message_content));
+END;
+
+-- server-side sessions of the browsers, see SessionStore.py
+CREATE TABLE web_sessions (
+    session_key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+CREATE INDEX idx_web_sessions_expires ON web_sessions (expires_at);
+
+-- schema version, must match len(Database.migrations)
+PRAGMA user_version = 7;
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+import argparse
+from flask import Flask
+
+'''
+    备注：
+    生产环境的入口，App.py中的app.run(debug=True)只用于开发
+    使用方法：
+    1. gunicorn（配置见gunicorn.conf.py）：gunicorn "Server:create_app()"
+    2. waitress：waitress-serve --port 5050 --call Server:create_app，或者python Server.py
+    gunicorn的preload_app在主进程中调用一次create_app()，工作进程fork后共享已导入的模块和已编译的模板
+'''
+
+def create_app(preload_sdk: bool = False) -> Flask:
+    '''
+        Import the app and prepare the shared resources once, before the workers are forked
+            1. the database is created or migrated, then its connections are closed,
+               a SQLite connection must not be used across fork, every worker opens its own
+            2. all the templates are compiled into the template cache of Jinja
+            3. the OpenAI SDK is imported on the first API call, preload_sdk (or PRELOAD_SDK=1) imports it here instead
+    '''
+    import App
+    App.get_database().close()
+    for name in App.app.jinja_env.list_templates():
+        App.app.jinja_env.get_template(name)
+    if preload_sdk or os.getenv("PRELOAD_SDK", "").lower() in ("1", "true", "yes"):
+        from Invoker import load_openai
+        load_openai()
+    return App.app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the app with waitress")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    try:
+        from waitress import serve
+    except ImportError:
+        raise SystemExit("ERROR: waitress is not installed, run pip install waitress, or use gunicorn")
+    serve(create_app(), host=args.host, port=args.port, threads=args.threads)
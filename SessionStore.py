@@ -0,0 +1,186 @@
+import time
+import hmac
+import base64
+import hashlib
+import secrets
+import threading
+from typing import Callable, Optional, Union
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from Cache import LRUCache
+from Database import Database
+
+'''
+    备注：
+    服务器端会话：cookie中只保存一个随机的会话id，会话数据保存在服务器端的存储中
+    1. 与Flask默认的签名cookie相比，cookie不再携带API key等数据，每个请求也不需要验证签名和反序列化整个cookie
+    2. DatabaseSessionStore保存在数据库的web_sessions表中，多个工作进程共享
+    3. MemorySessionStore保存在进程内存中，只适用于单进程部署和测试
+    4. API key不以明文保存：写入存储前用SECRET_KEY派生的密钥加密（FieldCipher），数据库文件的副本或备份不会泄露API key
+'''
+
+class FieldCipher:
+    '''
+        Authenticated encryption of the sensitive session fields with keys derived from the secret key of the app
+            1. the keystream is HMAC-SHA256(key, nonce + counter) with a random 16-byte nonce per value (a PRF in counter mode)
+            2. the tag is HMAC-SHA256 over the nonce and the ciphertext with another key (encrypt-then-MAC)
+            3. decrypt() returns None if the value was not encrypted with the same secret key
+    '''
+    def __init__(self, secret_key: Union[str, bytes]):
+        if not secret_key:
+            raise RuntimeError("ERROR: SECRET_KEY is not set, the API keys cannot be stored in the sessions")
+        secret = secret_key.encode("utf-8") if isinstance(secret_key, str) else secret_key
+        self.encryption_key = hmac.new(secret, b"session field encryption", hashlib.sha256).digest()
+        self.authentication_key = hmac.new(secret, b"session field authentication", hashlib.sha256).digest()
+
+    def _xor(self, nonce: bytes, data: bytes) -> bytes:
+        stream = b"".join(hmac.new(self.encryption_key, nonce + i.to_bytes(4, "big"), hashlib.sha256).digest() for i in range((len(data) + 31) // 32))
+        return bytes(a ^ b for a, b in zip(data, stream))
+
+    def encrypt(self, value: str) -> str:
+        nonce = secrets.token_bytes(16)
+        ciphertext = self._xor(nonce, value.encode("utf-8"))
+        tag = hmac.new(self.authentication_key, nonce + ciphertext, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(nonce + ciphertext + tag).decode("ascii")
+
+    def decrypt(self, value) -> Optional[str]:
+        try:
+            data = base64.urlsafe_b64decode(value.encode("ascii"))
+        except Exception:
+            return None
+        if len(data) < 48:
+            return None
+        nonce, ciphertext, tag = data[:16], data[16:-32], data[-32:]
+        if not hmac.compare_digest(tag, hmac.new(self.authentication_key, nonce + ciphertext, hashlib.sha256).digest()):
+            return None
+        return self._xor(nonce, ciphertext).decode("utf-8")
+
+class ServerSession(CallbackDict, SessionMixin):
+    '''
+        Session data of one browser, identified by the opaque id in the cookie
+    '''
+    def __init__(self, initial: Optional[dict] = None, sid: Optional[str] = None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.new = sid is None
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.modified = False
+        # the id replaced by regenerate(), its data is deleted when the session is saved
+        self.previous_sid = None
+
+    def regenerate(self):
+        '''
+            Move the session to a new id, e.g. after the login, so that an id known before the login becomes useless
+        '''
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+class MemorySessionStore:
+    '''
+        Sessions in the memory of the process, expired after ttl seconds
+    '''
+    def __init__(self, max_sessions: int = 100000):
+        self.cache = LRUCache(max_sessions)
+
+    def get(self, sid: str) -> Optional[str]:
+        return self.cache.get(sid)
+
+    def put(self, sid: str, data: str, ttl: float):
+        self.cache.put(sid, data, ttl)
+
+    def delete(self, sid: str):
+        self.cache.pop(sid)
+
+class DatabaseSessionStore:
+    '''
+        Sessions in the web_sessions table, shared by all the worker processes
+            get_database is called on the first use, so that the database is not opened at import time
+    '''
+    def __init__(self, get_database: Callable[[], Database]):
+        self.get_database = get_database
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, sid: str) -> Optional[str]:
+        row = self.get_database().execute("SELECT data FROM web_sessions WHERE session_key = ? AND expires_at > ?", (sid, time.time()), fetchone=True)
+        return row["data"] if row else None
+
+    def put(self, sid: str, data: str, ttl: float):
+        db = self.get_database()
+        db.execute("INSERT OR REPLACE INTO web_sessions (session_key, data, expires_at) VALUES (?, ?, ?)", (sid, data, time.time() + ttl))
+        # delete the expired sessions once every 100 writes
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % 100 == 0
+        if trim:
+            db.execute("DELETE FROM web_sessions WHERE expires_at <= ?", (time.time(),))
+
+    def delete(self, sid: str):
+        self.get_database().execute("DELETE FROM web_sessions WHERE session_key = ?", (sid,))
+
+class ServerSessionInterface(SessionInterface):
+    '''
+        Flask session interface storing the session data in a session store
+            1. the cookie holds only the session id, with the cookie settings of the app (SESSION_COOKIE_*)
+            2. the data is written back only if the session was modified,
+               it expires PERMANENT_SESSION_LIFETIME after the last modification
+            3. an emptied session (e.g. logout) is deleted from the store together with its cookie
+            4. the encrypted_fields are encrypted in the store, a session whose fields cannot be decrypted
+               (e.g. after SECRET_KEY changed) is dropped and the user has to login again
+    '''
+    serializer = TaggedJSONSerializer()
+    encrypted_fields = ("api_key",)
+
+    def __init__(self, store):
+        self.store = store
+        self._cipher = None
+        self._cipher_secret = None
+
+    def get_cipher(self, app) -> FieldCipher:
+        if self._cipher is None or self._cipher_secret != app.secret_key:
+            self._cipher, self._cipher_secret = FieldCipher(app.secret_key), app.secret_key
+        return self._cipher
+
+    def open_session(self, app, request) -> ServerSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                data = self.serializer.loads(data)
+                for field in self.encrypted_fields:
+                    if field in data:
+                        data[field] = self.get_cipher(app).decrypt(data[field])
+                        if data[field] is None:
+                            self.store.delete(sid)
+                            return ServerSession()
+                return ServerSession(data, sid)
+        return ServerSession()
+
+    def save_session(self, app, session: ServerSession, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+        if not session.modified:
+            return
+        data = dict(session)
+        for field in self.encrypted_fields:
+            if field in data:
+                data[field] = self.get_cipher(app).encrypt(data[field])
+        self.store.put(session.sid, self.serializer.dumps(data), app.permanent_session_lifetime.total_seconds())
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
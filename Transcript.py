@@ -0,0 +1,103 @@
+import sys
+import json
+import argparse
+from datetime import datetime
+from typing import Iterable, Optional, TextIO
+from Database import Database
+
+'''
+    备注：
+    对话记录的导入/导出工具，文件格式为JSONL，每行一个JSON对象：
+    1. {"type": "session", "session_id": 1, "title": "...", "role": "...", "temp": 1.0, "created_at": "..."}
+    2. {"type": "message", "session_id": 1, "role": "user", "content": "..."}
+    消息行必须出现在其所属的会话行之后，session_id只用于关联文件中的会话和消息
+    导入和导出都是流式的，内存中最多保存一个批次的消息
+    使用方法：
+    python Transcript.py export <username> transcript.jsonl
+    python Transcript.py import <username> transcript.jsonl
+'''
+
+def export_transcripts(db: Database, user_id: int, output: TextIO, session_id: Optional[int] = None) -> int:
+    '''
+        Write the chat sessions and messages of the user as JSONL, return the number of messages
+    '''
+    sessions = "SELECT session_id, session_title, session_role, temp, session_created_at FROM chat_sessions WHERE user_id = ?"
+    params = (user_id,)
+    if session_id is not None:
+        sessions += " AND session_id = ?"
+        params = (user_id, session_id)
+    count = 0
+    for chat in db.iterate(sessions + " ORDER BY session_id", params):
+        output.write(json.dumps({"type": "session", "session_id": chat["session_id"], "title": chat["session_title"], "role": chat["session_role"], "temp": chat["temp"], "created_at": chat["session_created_at"]}, ensure_ascii=False) + "\n")
+        for message in db.iterate("SELECT message_role, message_content FROM messages WHERE user_id = ? AND session_id = ? ORDER BY message_id", (user_id, chat["session_id"])):
+            output.write(json.dumps({"type": "message", "session_id": chat["session_id"], "role": message["message_role"], "content": message["message_content"]}, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def import_transcripts(db: Database, user_id: int, lines: Iterable[str], batch_size: int = 50000) -> int:
+    '''
+        Read JSONL records and insert them for the user, return the number of messages
+            the messages are inserted with executemany, one transaction per batch
+    '''
+    session_ids = {}
+    batch = []
+    count = 0
+
+    def flush():
+        with db.transaction():
+            db.execute_many("INSERT INTO messages (user_id, session_id, message_role, message_content) VALUES (?, ?, ?, ?)", batch)
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.get("type") == "session":
+            created_at = record.get("created_at") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            session_ids[record["session_id"]] = db.insert("INSERT INTO chat_sessions (user_id, session_role, session_title, temp, session_created_at, last_activity_at) VALUES (?, ?, ?, ?, ?, ?)", (user_id, record.get("role"), record.get("title") or "Imported", record.get("temp", 1.0), created_at, created_at))
+        elif record.get("type") == "message":
+            if record["session_id"] not in session_ids:
+                raise ValueError(f"ERROR: Line {line_number}: message of an unknown session {record['session_id']}")
+            batch.append((user_id, session_ids[record["session_id"]], record["role"], record["content"]))
+            if len(batch) >= batch_size:
+                flush()
+                count += len(batch)
+                batch = []
+        else:
+            raise ValueError(f"ERROR: Line {line_number}: unknown record type")
+    if batch:
+        flush()
+        count += len(batch)
+    return count
+
+def get_user_id(db: Database, username: str, create: bool = False) -> int:
+    user = db.execute("SELECT user_id FROM users WHERE username = ?", (username,), fetchone=True)
+    if user:
+        return user["user_id"]
+    if not create:
+        raise ValueError(f"ERROR: Unknown user {username}")
+    return db.insert("INSERT INTO users (username) VALUES (?)", (username,))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import or export chat transcripts as JSONL")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("username")
+    parser.add_argument("path", help="JSONL file, - for stdin/stdout")
+    parser.add_argument("--session", type=int, help="export only this chat session")
+    parser.add_argument("--database", default="Data.db")
+    parser.add_argument("--schema", default="Schema.sql")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    db = Database(args.database, args.schema)
+    if args.command == "export":
+        user_id = get_user_id(db, args.username)
+        output = sys.stdout if args.path == "-" else open(args.path, "w", encoding="utf-8")
+        with output:
+            count = export_transcripts(db, user_id, output, args.session)
+        print(f"Exported {count} messages", file=sys.stderr)
+    else:
+        user_id = get_user_id(db, args.username, create=True)
+        lines = sys.stdin if args.path == "-" else open(args.path, "r", encoding="utf-8")
+        with lines:
+            count = import_transcripts(db, user_id, lines, args.batch_size)
+        print(f"Imported {count} messages", file=sys.stderr)
@@ -0,0 +1,17 @@
+import os
+
+# gunicorn "Server:create_app()" reads this file from the working directory
+
+bind = os.getenv("BIND", "0.0.0.0:5050")
+workers = int(os.getenv("WORKERS", "2"))
+
+# the streamed replies keep a request open for the whole answer, threads keep the other requests going meanwhile
+worker_class = "gthread"
+threads = int(os.getenv("THREADS", "8"))
+timeout = 120
+
+# create_app() runs once in the master, the workers share the imported modules and the compiled templates
+preload_app = True
+# with preloading the OpenAI SDK is imported once in the master and shared too,
+# imported lazily every worker would keep its own copy (about 20MB more private memory per worker, Benchmark.py startup)
+os.environ.setdefault("PRELOAD_SDK", "1")